@@ -28,6 +28,97 @@ Pandoc usage
     %% pandoc --filter pandoc-imagine document.md -o document.pdf
 
 
+Commands
+
+  Besides acting as a filter, pandoc-imagine also takes some commands:
+
+    %% pandoc-imagine render [-j N] docs/**/*.md
+
+  renders all codeblocks found in one or more documents (markdown or pandoc's
+  json) into `{im_dir}-images`, in parallel.  Identical codeblocks across
+  documents are rendered only once.  A later `pandoc --filter pandoc-imagine`
+  run will find everything in the cache.
+
+    %% pandoc-imagine watch [-j N] docs/*.md
+
+  renders codeblocks like `render` and then keeps watching the documents,
+  rendering just the codeblocks that changed whenever one is saved, without
+  blocking on those still rendering.  It prints events as json lines on
+  stdout, for a preview server to pick up:
+  - changed, a codeblock (new to the watch) with its output path
+  - rendered or failed, when its command has finished
+  - removed, a codeblock no longer in the document
+
+    %% pandoc-imagine stats [-n N] [ledger]
+
+  reports the slowest codeblocks, cache hit rates per document and per tool
+  and the disk space used per klass, as recorded in a ledger (see im_ledger).
+
+    %% pandoc-imagine cache migrate [-d im_dir] flat|sharded|pack
+
+  moves all files in `{im_dir}-images` to another layout (see im_layout).
+
+    %% pandoc-imagine cache serve [-b address] [-p port] directory
+
+  serves a directory as a simple remote cache over http (see im_cache).
+
+    %% pandoc-imagine cache export [-d im_dir] [-k key] bundle.zip [docs]
+    %% pandoc-imagine cache import [-d im_dir] bundle.zip
+
+  export writes the cache entries (inputs, outputs and .info files) of some
+  documents or keys, or else all of them, into a compressed bundle with an
+  index of checksums.  import merges a bundle into a cache, checking the
+  checksums and skipping files already present, e.g. to start a fresh CI
+  runner with a warm cache.
+
+    %% pandoc-imagine agent [-b address] [-p port] [-j N] [-s]
+
+  runs render jobs for other hosts (see im_agents).  An agent only runs the
+  programs of Imagine's workers and, with -s, shebang scripts (i.e. any
+  code).  It refuses to listen on other than a loopback address unless a
+  token is set, in $IMAGINE_AGENT_TOKEN on both ends.
+
+    %% IMAGINE_PROFILE=imagine.prof pandoc --filter pandoc-imagine ..
+
+  profiles Imagine itself (as filter or command) with cProfile, saving pstats
+  in the given file, or by sampling stacks if it ends in `.folded` (for
+  flamegraph.pl or speedscope).  A summary of the calls and seconds spent in
+  its hot spots (walk, get_cb_opts, get_md_opts, key hashing, anon_codeblock,
+  to_str/to_bytes, ..) is printed on stderr, with time spent running tools
+  (cmd) subtracted from the walk as Imagine's own overhead.  Commands report
+  seconds summed over their threads instead of percentages.
+
+    %% pandoc-imagine serve [--http [address:]port] [-d im_dir] [-j N]
+                           [-l klass=N] [-t [klass=]seconds] [-a klass]
+
+  renders codeblocks posted to `/render/<klass>?fmt=svg` (other query
+  parameters are im_ options, bar those set by the server) and replies with
+  the output, or its stdout for textual tools, straight from
+  `{im_dir}-images` if it was rendered before.  Identical requests arriving
+  together share a single render.  -l limits the parallel renders of a
+  klass, -t kills renders that take too long (60s by default).
+  `GET /metrics` reports request counts, hit rates and latencies per klass.
+  -a limits the klasses served, which are all but shebang (that runs any
+  script it is sent) by default.  It refuses to listen on other than a
+  loopback address unless clients are required to send the bearer token in
+  $IMAGINE_SERVE_TOKEN (or --token).
+
+
+Python usage
+
+    >>> from pandoc_imagine import render
+    >>> r = render('dot', 'digraph { a -> b }', im_fmt='svg')
+    >>> r.ok, r.path, r.cached
+    (True, 'pd-images/<hash>.svg', False)
+
+  renders a single codeblock of the given class, with keyword arguments as its
+  attributes, and returns a RenderResult(ok, path, data, stdout, stderr,
+  cached, key).  It uses (and fills) the same cache as the filter and may be
+  called from several threads at once, e.g. by a web app or a static site
+  generator; calls for a codeblock being rendered wait for and share its
+  result.
+
+
 Markdown usage
 
     ```cmd
@@ -79,6 +170,14 @@ Imagine options
     maps gri to `gri`, but that can be changed by `{.gri im_prg="gri2"} to use
     `gri2` instead of `gri`.
 
+  - im_draft=0, or 1 for quick, cheaper renders while authoring: lower
+    resolutions for raster output, faster graphviz layouts, no
+    im_reproducible normalization and no im_cache.  Commands see
+    $IMAGINE_DRAFT=1, so scripts can cut corners as well.  Drafts are cached
+    separately, so turning it off again reuses the earlier final renders.
+    Defaults to $IMAGINE_DRAFT, if set, or use `--draft` on `render` or
+    `watch`.
+
   - im_fmt="png", or another output format of your choosing depending on the
     command line tool used.  Some tools donot derive their output image format
     from an intended output file name extension, but instead require it to be
@@ -86,15 +185,109 @@ Imagine options
     in the codeblock matches `im_fmt` or pandoc may have trouble assembling the
     final document.
 
+  - im_agents="", or a csv-list of agents (host:port) to run commands on,
+    e.g. for tools not installed locally.  Best set per klass in the
+    metadata, e.g. `imagine.mermaid.im_agents: build1:8009,build2:8009`.  A
+    job is sent to the least busy agent, along with its input file, and its
+    output files, stdout and stderr are pulled back.  Agents that cannot be
+    reached are skipped for a while and if none takes the job, it is run
+    locally.  Defaults to $IMAGINE_AGENTS, if set.
+
+  - im_cache="", or the url of a remote cache shared by many machines, like
+    `http://cache.example.com/imagine`.  Outputs missing in `{im_dir}-images`
+    are looked up there (GET <url>/<hash>.ext) before running any command and
+    fresh renders are uploaded (PUT), unless im_cache_mode="ro".  Defaults to
+    $IMAGINE_CACHE, if set; $IMAGINE_CACHE_TOKEN is sent as a bearer token.
+    A `file:///path` url uses a (shared) directory instead.  A remote cache
+    that cannot be reached is skipped for 30 seconds.
+
+  - im_cache_mode="rw", or "ro" to only fetch from im_cache.
+
+  - im_budget=0, or the number of seconds a pandoc run may spend rendering.
+    Codeblocks not cached and expected to exceed the budget are left as-is
+    (or shown as im_placeholder) and rendered by a detached
+    `pandoc-imagine render` instead, so a later run finds them in the cache.
+    The first render of a run always goes ahead.  Deferred codeblocks are
+    reported on stderr and the background render logs to
+    `{im_dir}-images/deferred.log`.
+
+  - im_placeholder="", or the text to show in place of a deferred render,
+    e.g. "({klass} diagram is being rendered)".  By default, the codeblock is
+    kept.
+
+  - im_dims=0, or 1 to add the intrinsic width and height of an image (as
+    pixels, read from its png, gif, svg or pdf header) and loading="lazy" to
+    its attributes when writing html, epub or html slides, so browsers need
+    not reflow the page while loading.  Other formats (like LaTeX, which fits
+    images to the line width) are left alone.  The size is kept in the
+    `<hash>.info` file, so unchanged images are not read again.  Any width or
+    height given on the codeblock wins.
+
+  - im_scratch=0, or 1 to run each command in a scratch directory of its
+    own, so tools that leave files in their working directory (gri, gle, some
+    scripts) can run in parallel.  Its output (and any declared products,
+    like gri's .ps) is moved into `{im_dir}-images` when done, the rest is
+    discarded.  Codeblocks that read files relative to the document's
+    directory (like `dta/gri-01.dat`) won't find them there, so by default
+    commands run in the current working directory.
+
+  - im_tmpdir="", or where to create scratch dirs, e.g. /dev/shm for tmpfs.
+    Defaults to the system's temporary directory.
+
   - im_dir="pd", or antoher absolute or relative (to the working directory)
     path in which input/output files are to be stored during processing.
     Note that an "-images" is still tacked onto the end of the path though.
 
+  - im_layout="flat", stores all files directly in `{im_dir}-images`.  Huge
+    caches are better off using "sharded", which stores <hash>.ext files as
+    `{im_dir}-images/ha/sh/<hash>.ext`, or "pack" which does the same but keeps
+    inputs and text outputs (like figlet's) together in an indexed,
+    append-only `pack.dat` file.  Best set in the metadata and switch layouts
+    using `pandoc-imagine cache migrate`.
+
+  - im_ledger="", or the path of an sqlite database in which to record every
+    render and cache hit: klass, tool, document, wall and cpu time, peak
+    memory and in/output sizes.  Defaults to $IMAGINE_LEDGER, if set.  Note
+    that a filter never sees the name of its input document, so it records
+    the document's title instead.
+
   - im_log=0, which defaults to printing only errors caught during processing.
     Set it to -1 to completely silence Imagine, or as high as 4 for debug level
     output if somethings goes wrong and you need more information on what is
     going on.
 
+  - im_jobs=0, or the max number of codeblocks of a klass to render in
+    parallel (when using `pandoc-imagine render`).  Heavy tools like mermaid
+    and plantuml default to 2.  Best set per klass, e.g. in the metadata as
+    `imagine.mermaid.im_jobs: 1`.
+
+  - im_mem=50, or the memory in MB a single run of the tool is expected to
+    claim.  Parallel renders are limited to the memory (and cpus) available to
+    Imagine, taking cgroup limits into account.
+
+  - im_max_output=1048576, or the max number of bytes of stdout and stderr
+    (0 for no limit) to keep of a command.  Anything beyond is cut off and
+    replaced by a marker, so a runaway script cannot eat all memory.  Text
+    tools (figlet, boxes, protocol) write their stdout straight into their
+    output file, which is read back only if needed.  Tools that output an
+    image on stdout are not limited.
+
+  - im_timeout=0, or the number of seconds after which a command is killed.
+    A command that timed out is not remembered as a failure.
+
+  - im_reproducible=0, or 1 to have identical codeblocks always produce
+    byte-identical png, pdf and svg outputs.  Commands are run with
+    $SOURCE_DATE_EPOCH (0, unless set) and fresh outputs are stripped of
+    timestamps and software versions (png), get fixed dates and ids (pdf) or
+    lose their comments and get stable ids in place of generated ones (svg).
+
+  - im_retry=0, or 1 to retry a codeblock whose command failed on a previous
+    run.  Normally, a failure is remembered and its diagnostics are simply
+    replayed until the codeblock, its options or the command itself changes.
+    Setting it on a codeblock does not change its cache key, so it can be
+    removed again once the retry succeeded.  Defaults to $IMAGINE_RETRY, if
+    set (or use `pandoc-imagine render --retry`), e.g. to retry all in CI.
+
   Option values are resolved in order of most to least specific:
 
   1. {.klass im_xyz=".."}       codeblock specific
@@ -107,19 +300,26 @@ Imagine options
   - uses subdir `{im_dir}-images` to store any input/output files
   - there's no clean up of files stored there
   - if an output filename exists, it is not regenerated but simply linked to.
+  - failures and render durations are stored in a `<hash>.info` file
+  - renders with the longest previous duration are started first
   - `packetdiag`'s underlying library seems to have some problems.
 
   Some commands follow a slightly different pattern:
   - 'img' directive is ignored by commands that only produce ascii
   - ctioga2 defaults to pdf instead of png
   - flydraw produces a gif, not png
-  - gle also creates a .gle subdir inside the images-dir
-  - gri produces a ps, which is `convert`ed to png
+  - gle also creates a .gle subdir in its (scratch) working dir
+  - gri produces a ps in its working dir, which is `convert`ed to png
   - imagine reads its code as help-topics, returns codeblocks with help-info
   - plot reads its codeblock as the relative path to the file to process
   - pyxplot will have `set terminal` & `set output` prepended to its `code`
   - shebang runs its codeblock as a script with <fname>.{im_fmt} as its argument.
     - use {.shebang im_out="stdout"} for text instead of an png
+    - use {.shebang im_warm=1 im_preload="numpy,matplotlib.pyplot"} to run a
+      python script in a forked copy of an interpreter that already imported
+      those modules, which saves startup time when there are many scripts.
+  - blockdiag & friends and protocol are python programs, so they are run in
+    warm interpreters by default (im_warm=0 runs them as commands instead).
 
 
 Security
@@ -154,11 +354,36 @@ Thanks for feedback:
 
 from __future__ import print_function
 
+import io
 import os
+import re
 import sys
 import stat
+import json
+import glob
+import struct
+import select
+import signal
+import base64
+import random
+import argparse
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from time import time, sleep, gmtime, strftime, perf_counter
+from contextlib import contextmanager
+from collections import namedtuple, deque
 from textwrap import wrap
-from subprocess import Popen, CalledProcessError, PIPE
+from subprocess import Popen, CalledProcessError, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlsplit, quote, parse_qsl
+
+try:
+    import fcntl               # optional, locks the pack store
+except ImportError:
+    fcntl = None
 
 # non-standard libraries
 from six import with_metaclass
@@ -197,6 +422,11 @@ def to_str(s, enc='ascii'):
         return to_str(str(s))
 
 
+def to_bool(s):
+    'return truth value of an option value like 1, yes, on or true'
+    return to_str(s).strip().lower() in ('1', 'y', 'yes', 'on', 'true')
+
+
 def to_bytes(s, enc='ascii'):
     'return decoded char sequence for s'
     # in PY2 isinstance(str(), bytes) == True
@@ -219,6 +449,1245 @@ def to_bytes(s, enc='ascii'):
     except UnicodeEncodeError:
         return s.encode(enc, err)
 
+
+def tool_id(prg):
+    'return a fingerprint [path, size, mtime] of an executable, or None'
+    path = prg if os.path.dirname(prg) else shutil.which(prg)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.realpath(path), st.st_size, int(st.st_mtime)]
+
+
+def cutoff(dropped):
+    'return the marker that replaces output beyond its limit'
+    return to_bytes('\n[imagine: %d more bytes cut off, see im_max_output]\n'
+                    % dropped)
+
+
+def capture(src, limit=None, sink=None):
+    'read src until eof, return up to limit bytes or write them to sink'
+    # the rest is read as well, so a chatty child is not blocked, but only
+    # counted and replaced by a marker
+    read = getattr(src, 'read1', src.read)
+    chunks, kept, dropped = [], 0, 0
+    while True:
+        chunk = read(64 * 1024)
+        if not chunk:
+            break
+        if limit is not None and kept + len(chunk) > limit:
+            dropped += kept + len(chunk) - max(kept, limit)
+            chunk = chunk[:max(0, limit - kept)]
+        kept += len(chunk)
+        if sink is not None:
+            sink.write(chunk)
+        else:
+            chunks.append(chunk)
+    if dropped:
+        if sink is not None:
+            sink.write(cutoff(dropped))
+        else:
+            chunks.append(cutoff(dropped))
+    return b''.join(chunks)
+
+
+def truncate(path, limit=None):
+    'cut off a file beyond limit bytes, like capture does'
+    size = os.path.getsize(path)
+    if limit is not None and size > limit:
+        with open(path, 'r+b') as f:
+            f.seek(limit)
+            f.truncate()
+            f.write(cutoff(size - limit))
+
+
+def loopback(host):
+    'return True if host is a loopback address, i.e. only reachable locally'
+    import ipaddress
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def spawn(args, stdin=None, timeout=None, limits=None, spill=None, **kwargs):
+    'run a command, return (returncode, stdout, stderr, usage)'
+    # like Popen.communicate, but the child is reaped using wait4 so its
+    # resource usage (cpu seconds, peak rss in bytes) is known as well.
+    # A child still running after timeout seconds is killed.  Output beyond
+    # limits['out'] or ['err'] bytes is cut off and stdout is written to the
+    # spill file as it arrives (returning None as stdout), if one is given.
+    limits = limits or {}
+    if timeout and hasattr(os, 'killpg'):
+        # so the tool's own children (shells, wrappers) can be killed too
+        kwargs['start_new_session'] = True
+    p = Popen(args, stdin=None if stdin is None else PIPE, stdout=PIPE,
+              stderr=PIPE, **kwargs)
+    killed = threading.Event()
+
+    def kill():
+        'kill the child and its process group'
+        killed.set()
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except (OSError, AttributeError):
+            p.kill()
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+    bufs = {}
+
+    def drain(name, pipe):
+        'read a pipe until eof'
+        if name == 'out' and spill:
+            with open(spill, 'wb') as f:
+                capture(pipe, limits.get(name), f)
+            bufs[name] = None
+        else:
+            bufs[name] = capture(pipe, limits.get(name))
+        pipe.close()
+
+    readers = [threading.Thread(target=drain, args=pipe)
+               for pipe in (('out', p.stdout), ('err', p.stderr))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    if stdin is not None:
+        try:
+            p.stdin.write(to_bytes(stdin))
+            p.stdin.close()
+        except (IOError, OSError):
+            pass  # child exited without reading all its input
+    grace = None
+    for reader in readers:
+        # once killed, processes that left its group may still hold on to
+        # the pipes, so their readers are given a moment and then abandoned
+        while reader.is_alive() and not killed.is_set():
+            reader.join(0.1)
+        grace = grace or time() + 1
+        reader.join(max(0, grace - time()))
+    out = bufs.get('out', None if spill else b'')
+    err = bufs.get('err', b'')
+
+    if not hasattr(os, 'wait4'):
+        p.wait()
+        if timer:
+            timer.cancel()
+        return p.returncode, out, err, {}
+
+    _, status, ru = os.wait4(p.pid, 0)
+    if timer:
+        timer.cancel()
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    scale = 1 if sys.platform == 'darwin' else 1024  # linux reports KB
+    usage = {'cpu': ru.ru_utime + ru.ru_stime, 'rss': ru.ru_maxrss * scale}
+    return p.returncode, out, err, usage
+
+
+def shebang_python(line):
+    'return path of the python interpreter named by a #!-line, or None'
+    words = line[2:].split() if line.startswith('#!') else []
+    if words and os.path.basename(words[0]) == 'env':
+        words = words[1:]
+    # interpreter options (like -u) would be lost, so skip those as well
+    if len(words) != 1:
+        return None
+    if not re.match(r'python[0-9.]*$', os.path.basename(words[0])):
+        return None
+    return shutil.which(words[0])
+
+
+def script_python(prg):
+    'return path of the python interpreter for a script on $PATH, or None'
+    path = shutil.which(prg)
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return shebang_python(to_str(f.readline(256), 'utf-8').strip())
+    except (OSError, IOError):
+        return None
+
+
+PX = {'': 1.0, 'px': 1.0, 'pt': 96 / 72.0, 'pc': 16.0, 'in': 96.0,
+      'cm': 96 / 2.54, 'mm': 9.6 / 2.54}  # css pixels per unit
+
+
+def image_size(path):
+    'return (width, height) in pixels of a png, gif, svg or pdf, or None'
+    # only looks at the header, or the first and last 64KB of a pdf
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(64 * 1024)
+            if head.startswith(b'%PDF'):
+                f.seek(max(len(head), os.fstat(f.fileno()).st_size - 64 * 1024))
+                head += f.read()
+    except (OSError, IOError):
+        return None
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head.startswith(b'%PDF'):
+        m = re.search(br'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+'
+                      br'([-\d.]+)\s+([-\d.]+)\s*\]', head)
+        if m:
+            x0, y0, x1, y1 = [float(x) for x in m.groups()]
+            return (int(round(abs(x1 - x0) * PX['pt'])),
+                    int(round(abs(y1 - y0) * PX['pt'])))
+        return None
+
+    m = re.search(br'<svg\b[^>]*>', head)
+    if not m:
+        return None
+    tag = to_str(m.group(0), 'utf-8')
+    attrs = dict(re.findall(r'([\w:-]+)\s*=\s*["\']([^"\']*)["\']', tag))
+    size = []
+    for attr in ('width', 'height'):
+        m = re.match(r'\s*([\d.]+)\s*([a-z]*)\s*$', attrs.get(attr, ''))
+        if m and m.group(2) in PX:
+            size.append(int(round(float(m.group(1)) * PX[m.group(2)])))
+    if len(size) == 2:
+        return tuple(size)
+    box = attrs.get('viewBox', '').replace(',', ' ').split()
+    try:
+        return int(round(float(box[2]))), int(round(float(box[3])))
+    except (IndexError, ValueError):
+        return None
+
+
+def normalize_png(data):
+    'return png without timestamps and software versions in its chunks'
+    out, pos = [data[:8]], 8
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 12 + size
+        keep = kind != b'tIME'
+        if kind in (b'tEXt', b'zTXt', b'iTXt'):
+            word = data[pos + 8:end].split(b'\0', 1)[0].lower()
+            keep = not any(w in word for w in (b'date', b'time', b'software'))
+        if keep:
+            out.append(data[pos:end])
+        pos = end
+    return b''.join(out)
+
+
+def normalize_pdf(data, epoch, salt):
+    'return pdf with fixed dates and ids, keeping all offsets intact'
+    # every replacement has the same length as the original, so the xref
+    # table and stream lengths remain valid
+    fixed = {}
+
+    def same(old, *new):
+        'longest of new that fits, padded with spaces to the length of old'
+        fits = [n for n in new if len(n) <= len(old)] or [new[-1][:len(old)]]
+        return max(fits, key=len).ljust(len(old))
+
+    def stable(m):
+        'replace random hex digits (e.g. of a uuid) by ones derived from salt'
+        old = m.group(0)
+        if old not in fixed:
+            digest = hashlib.sha1(to_bytes('%s%d' % (salt, len(fixed))))
+            digest = digest.hexdigest().encode() * 4
+            new = bytearray(old)
+            for idx, c in enumerate(new):
+                if c in b'0123456789abcdefABCDEF':
+                    new[idx] = digest[idx % len(digest)]
+            fixed[old] = bytes(new)
+        return fixed[old]
+
+    utc = gmtime(epoch)
+    dates = [strftime(fmt, utc).encode() for fmt in (
+        "D:%Y%m%d%H%M%S+00'00'", 'D:%Y%m%d%H%M%SZ', 'D:%Y%m%d%H%M%S')]
+    isos = [strftime(fmt, utc).encode() for fmt in (
+        '%Y-%m-%dT%H:%M:%S+00:00', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S')]
+    data = re.sub(br'(/(?:CreationDate|ModDate)\s*\()(D:[^)]*)',
+                  lambda m: m.group(1) + same(m.group(2), *dates), data)
+    data = re.sub(br'(xmp:(?:CreateDate|ModifyDate|MetadataDate)'
+                  br'(?:>|\s*=\s*["\']))([^<"\']*)',
+                  lambda m: m.group(1) + same(m.group(2), *isos), data)
+    data = re.sub(br'(?<=uuid:)[0-9a-fA-F-]{32,36}', stable, data)
+    data = re.sub(br'(?<=/ID)\s*\[\s*<[0-9a-fA-F]+>\s*<[0-9a-fA-F]+>',
+                  stable, data)
+    return data
+
+
+def normalize_svg(data, salt):
+    'return svg without comments and dates, with generated ids made stable'
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data
+    text = re.sub(r'<!--.*?-->\s*', '', text, flags=re.S)
+    text = re.sub(r'<dc:date>.*?</dc:date>\s*', '', text, flags=re.S)
+    # ids with long runs of digits or hex are taken to be generated (from
+    # timestamps or random numbers), so rename them as id="..", url(#..) and
+    # (xlink:)href="#.." but leave any text content alone
+    ids = {}
+    for m in re.finditer(r'\bid\s*=\s*["\']([^"\']+)["\']', text):
+        if m.group(1) not in ids and \
+                re.search(r'\d{5,}|[0-9a-f]{8,}', m.group(1), re.I):
+            ids[m.group(1)] = 'im%s-%d' % (salt[:8], len(ids))
+
+    def rename(m):
+        'return an id or reference to it, renamed if generated'
+        return m.group(1) + ids.get(m.group(2), m.group(2))
+
+    if ids:
+        text = re.sub(r'(\bid\s*=\s*["\']|\burl\(\s*["\']?#|'
+                      r'\bhref\s*=\s*["\']#)([^"\'()\s]+)', rename, text)
+    return text.encode('utf-8')
+
+
+def normalize(path, epoch, salt):
+    'rewrite a png, pdf or svg file so identical inputs give identical bytes'
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        new = normalize_png(data)
+    elif data.startswith(b'%PDF'):
+        new = normalize_pdf(data, epoch, salt)
+    elif re.search(br'<svg\b', data[:4096]):
+        new = normalize_svg(data, salt)
+    else:
+        return False
+    if new == data:
+        return False
+    tmpfile = '%s.%s.tmp' % (path, threading.current_thread().ident)
+    with open(tmpfile, 'wb') as f:
+        f.write(new)
+    os.replace(tmpfile, path)
+    return True
+
+
+def read_cgroup(*paths):
+    'return stripped contents of first readable (cgroup) file, or None'
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except (OSError, IOError):
+            continue
+    return None
+
+
+def get_limits():
+    'return (cpus, memory bytes) available to this process, cgroups included'
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = None
+
+    # cgroup v2 has 'quota period' in cpu.max, v1 has two separate files
+    quota = read_cgroup('/sys/fs/cgroup/cpu.max')
+    if quota is not None:
+        quota = quota.split()
+    else:
+        quota = [read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'),
+                 read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+    try:
+        quota, period = int(quota[0]), int(quota[1])
+        if quota > 0 and period > 0:
+            cpus = min(cpus, max(1, -(-quota // period)))
+    except (TypeError, ValueError, IndexError):
+        pass  # 'max', -1 or missing means no quota
+
+    limit = read_cgroup('/sys/fs/cgroup/memory.max',
+                        '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    try:
+        limit = int(limit)
+        memory = limit if memory is None else min(memory, limit)
+    except (TypeError, ValueError):
+        pass  # 'max' or missing means no limit
+    return cpus, memory
+
+
+class Scheduler(object):
+    'admit commands to run subject to cpu, memory and per klass limits'
+    # Waiting commands are admitted longest expected duration first, so slow
+    # renders start early and do not end up dragging out the total run time.
+    alpha = 0.3               # weight of a new duration in its klass average
+    default = 1.0             # expected seconds for a klass never seen before
+
+    def __init__(self):
+        self.cpus, memory = get_limits()
+        # leave some headroom for pandoc & imagine itself
+        self.memory = None if memory is None else int(memory * 0.8)
+        self.cond = threading.Condition()
+        self.waiting = []     # tickets of commands waiting to be admitted
+        self.running = {}     # klass -> number of running commands
+        self.jobs = 0         # total number of running commands
+        self.used = 0         # total memory (bytes) claimed by running commands
+        self.seq = 0          # tie breaker for tickets, first come first serve
+        self.durations = {}   # klass -> moving average of durations
+
+    def expect(self, klass, durations=None):
+        'return expected duration for a klass, or given past durations'
+        if durations:
+            return sum(durations.values())
+        return self.durations.get(klass, self.default)
+
+    def learn(self, klass, seconds):
+        'update moving average of durations seen for klass'
+        with self.cond:
+            avg = self.durations.get(klass, seconds)
+            self.durations[klass] = avg + self.alpha * (seconds - avg)
+
+    def fits(self, ticket):
+        'say whether a ticket can be admitted given current load'
+        klass, jobs, mem = ticket[2:5]
+        if self.jobs == 0:
+            return True       # always admit something, however big
+        if self.jobs >= self.cpus:
+            return False
+        if jobs > 0 and self.running.get(klass, 0) >= jobs:
+            return False
+        return self.memory is None or self.used + mem <= self.memory
+
+    @contextmanager
+    def slot(self, klass, jobs=0, mem=0, expected=None):
+        'block until a command of klass may run, release its slot afterwards'
+        expected = self.expect(klass) if expected is None else expected
+        with self.cond:
+            self.seq += 1
+            ticket = (-expected, self.seq, klass, jobs, mem)
+            self.waiting.append(ticket)
+            while True:
+                admit = [t for t in sorted(self.waiting) if self.fits(t)]
+                if admit and admit[0] is ticket:
+                    break
+                self.cond.wait()
+            self.waiting.remove(ticket)
+            self.running[klass] = self.running.get(klass, 0) + 1
+            self.jobs += 1
+            self.used += mem
+            self.cond.notify_all()  # others might fit as well
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running[klass] -= 1
+                self.jobs -= 1
+                self.used -= mem
+                self.cond.notify_all()
+
+
+scheduler = Scheduler()
+
+
+class Budget(object):
+    'the time a filter run may spend rendering, see im_budget'
+    # Renders that would exceed the budget are deferred and handed to a
+    # detached 'render' process once the document has been filtered.
+
+    def __init__(self):
+        self.started = time()
+        self.enabled = False  # only a filter run is on a budget
+        self.deferred = []    # workers whose renders were deferred
+        self.admitted = 0     # renders allowed so far
+        self.lock = threading.Lock()
+
+    def allows(self, seconds, expected):
+        'say whether a render expected to take this long fits the budget'
+        # the first render always runs, so a cold cache (where every render
+        # is expected to take a default second) still makes progress
+        if not self.enabled or seconds <= 0:
+            return True
+        with self.lock:
+            if self.admitted and time() - self.started + expected > seconds:
+                return False
+            self.admitted += 1
+            return True
+
+    def defer(self, worker):
+        'remember a worker whose render did not fit the budget'
+        with self.lock:
+            self.deferred.append(worker)
+
+    @staticmethod
+    def claim(worker):
+        'say whether a deferred render is not already queued, queue it if so'
+        # <key>.deferred holds the pid of the background render (or of the
+        # filter run that is launching it), until that process is gone
+        lock = worker.basename + '.deferred'
+        for _ in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                             0o644)
+            except OSError:
+                try:
+                    with open(lock) as f:
+                        os.kill(int(f.read()), 0)
+                    return False      # its render is still running
+                except ProcessLookupError:
+                    pass              # a stale lock
+                except (OSError, ValueError):
+                    if time() - os.path.getmtime(lock) < 60:
+                        return False  # being written or not ours to check
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+                continue
+            os.write(fd, to_bytes(str(os.getpid())))
+            os.close(fd)
+            return True
+        return False
+
+    @staticmethod
+    def release(worker):
+        'remove the lock of a deferred render, once this process handled it'
+        lock = worker.basename + '.deferred'
+        try:
+            with open(lock) as f:
+                if f.read().strip() != str(os.getpid()):
+                    return            # no lock, or some other process's
+            os.remove(lock)
+        except (OSError, IOError):
+            pass
+
+    def launch(self, meta, fmt, version=None):
+        'start a detached render of all deferred codeblocks, if any'
+        keys, claimed = set(), []
+        for w in self.deferred:
+            if w.key in keys:
+                continue              # the same codeblock, deferred twice
+            keys.add(w.key)
+            if self.claim(w):
+                claimed.append(w)
+            else:
+                print('Imagine: - %s %s is being rendered in the background '
+                      'already' % (w.klass, w.outfile), file=sys.stderr)
+        self.deferred = claimed
+        if not self.deferred:
+            return None
+        blocks = [pf.CodeBlock(*w.codec) for w in self.deferred]
+        doc = {'pandoc-api-version': version or [1, 23], 'meta': meta,
+               'blocks': blocks}
+        store = self.deferred[0].store
+        log = open(os.path.join(store.root, 'deferred.log'), 'ab')
+        try:
+            # a profiled filter run keeps its profile to itself
+            env = dict((k, v) for k, v in os.environ.items()
+                       if k != 'IMAGINE_PROFILE')
+            p = Popen([sys.executable, os.path.abspath(__file__), 'render',
+                       '-t', fmt, '-'], stdin=PIPE, stdout=log, stderr=log,
+                      env=env, start_new_session=True)
+            p.stdin.write(to_bytes(json.dumps(doc), 'utf-8'))
+            p.stdin.close()
+        except OSError as e:
+            print('Imagine: could not render deferred codeblocks (%s)' % e,
+                  file=sys.stderr)
+            for w in self.deferred:
+                os.remove(w.basename + '.deferred')
+            return None
+        finally:
+            log.close()
+        for w in self.deferred:
+            with open(w.basename + '.deferred', 'w') as f:
+                f.write(str(p.pid))
+        print('Imagine: %d codeblocks deferred, rendering them in the '
+              'background (pid %d, see %s)' % (
+                  len(self.deferred), p.pid, log.name), file=sys.stderr)
+        for w in self.deferred:
+            print('Imagine: - deferred %s %s' % (w.klass, w.outfile),
+                  file=sys.stderr)
+        return p.pid
+
+
+budget = Budget()
+
+
+class Ledger(object):
+    'a sqlite ledger of renders and cache hits, shared by threads'
+    fields = 'at klass tool key doc hit ok wall cpu rss insize outsize'.split()
+    schema = '''create table if not exists renders (
+                  at real, klass text, tool text, key text, doc text,
+                  hit integer, ok integer, wall real, cpu real, rss integer,
+                  insize integer, outsize integer)'''
+    ledgers = {}              # path -> Ledger
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        'return the ledger for path, opening it if needed'
+        with cls.lock:
+            if path not in cls.ledgers:
+                cls.ledgers[path] = cls(path)
+            return cls.ledgers[path]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        try:
+            import sqlite3     # optional, and slow to import
+        except ImportError:
+            print('Imagine: ledger %r disabled, no sqlite3' % path,
+                  file=sys.stderr)
+            return
+        try:
+            self.db = sqlite3.connect(path, timeout=30,
+                                      check_same_thread=False)
+            self.db.execute('pragma journal_mode=wal')
+            self.db.execute(self.schema)
+            self.db.commit()
+        except sqlite3.Error as e:
+            print('Imagine: ledger %r disabled (%s)' % (path, e),
+                  file=sys.stderr)
+            self.db = None
+
+    def record(self, **row):
+        'add a row to the ledger'
+        if self.db is None:
+            return
+        import sqlite3
+        row['at'] = time()
+        sql = 'insert into renders (%s) values (%s)' % (
+            ', '.join(self.fields), ', '.join('?' for f in self.fields))
+        with self.lock:
+            try:
+                self.db.execute(sql, [row.get(f) for f in self.fields])
+                self.db.commit()
+            except sqlite3.Error as e:
+                print('Imagine: ledger %r: %s' % (self.path, e),
+                      file=sys.stderr)
+
+    def query(self, sql, *args):
+        'return all rows for a query'
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+
+class Pack(object):
+    'an indexed, append-only file holding many small files by name'
+    # <path>.dat holds the data, <path>.idx holds a json line per file:
+    # [name, offset, length].  A later line for the same name supersedes
+    # earlier ones, so files can be rewritten (at the cost of some space).
+
+    def __init__(self, path):
+        self.datfile = path + '.dat'
+        self.idxfile = path + '.idx'
+        self.index = {}       # name -> (offset, length)
+        self.seen = 0         # bytes of idxfile read so far
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        'pick up index lines appended (by any process) since last time'
+        try:
+            with open(self.idxfile, 'rb') as f:
+                f.seek(self.seen)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # a partial line is still being written
+                    self.seen += len(line)
+                    name, offset, length = json.loads(to_str(line, 'utf-8'))
+                    self.index[name] = (offset, length)
+        except (OSError, IOError, ValueError):
+            pass
+
+    def entry(self, name):
+        'return (offset, length) for name or None'
+        with self.lock:
+            if name not in self.index:
+                self.refresh()
+            return self.index.get(name)
+
+    def names(self):
+        'return names of all files in the pack'
+        with self.lock:
+            self.refresh()
+            return sorted(self.index)
+
+    def get(self, name):
+        'return data for name, or None'
+        entry = self.entry(name)
+        if entry is None:
+            return None
+        with open(self.datfile, 'rb') as f:
+            f.seek(entry[0])
+            return f.read(entry[1])
+
+    def put(self, name, data):
+        'append data for name, unless it is already there'
+        data = to_bytes(data, 'utf-8')
+        if self.get(name) == data:
+            return  # e.g. an inpfile rewritten on every run
+        with self.lock:
+            with open(self.datfile, 'ab') as dat:
+                if fcntl:
+                    fcntl.flock(dat, fcntl.LOCK_EX)  # other processes
+                try:
+                    dat.seek(0, os.SEEK_END)
+                    offset = dat.tell()
+                    dat.write(data)
+                    dat.flush()
+                    line = json.dumps([name, offset, len(data)]) + '\n'
+                    with open(self.idxfile, 'ab') as idx:
+                        idx.write(to_bytes(line))
+                finally:
+                    if fcntl:
+                        fcntl.flock(dat, fcntl.LOCK_UN)
+            self.index[name] = (offset, len(data))
+
+
+class Store(object):
+    'map cache keys to files in {im_dir}-images, using one of its layouts'
+    # - flat     <root>/<key>.<ext>
+    # - sharded  <root>/<k[0:2]>/<k[2:4]>/<key>.<ext>
+    # - pack     sharded, but inputs and text outputs are kept in a Pack
+    layouts = ('flat', 'sharded', 'pack')
+    stores = {}               # (root, layout) -> Store
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, im_dir, layout='flat'):
+        'return the store for im_dir with given layout'
+        with cls.lock:
+            if (im_dir, layout) not in cls.stores:
+                cls.stores[(im_dir, layout)] = cls(im_dir, layout)
+            return cls.stores[(im_dir, layout)]
+
+    @staticmethod
+    def key(content):
+        'return cache key for some content, e.g. a codeblock'
+        # same as pandocfilters' get_filename4code, so existing caches remain
+        # valid
+        return hashlib.sha1(
+            content.encode(sys.getfilesystemencoding())).hexdigest()
+
+    def __init__(self, im_dir, layout='flat'):
+        if layout not in self.layouts:
+            raise ValueError('unknown im_layout %r' % layout)
+        self.layout = layout
+        if os.getenv('PANDOCFILTER_CLEANUP'):
+            # honor pandocfilters' request for a throw-away cache
+            self.root = tempfile.mkdtemp(prefix=im_dir)
+            atexit.register(shutil.rmtree, self.root, True)
+        else:
+            self.root = im_dir + '-images'
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.pack = None
+        if layout == 'pack':
+            self.pack = Pack(os.path.join(self.root, 'pack'))
+
+    def path(self, key, ext=None):
+        'return the (stable) path for key, optionally with an extension'
+        if self.layout == 'flat':
+            path = os.path.join(self.root, key)
+        else:
+            path = os.path.join(self.root, key[0:2], key[2:4], key)
+        return path if ext is None else '%s.%s' % (path, ext)
+
+    def basename(self, key):
+        'return path for key without extension, ensure its directory exists'
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # created by another thread or process
+        return path
+
+    def files(self):
+        'return paths of all cache files found, in any layout'
+        found = []
+        for dirpath, dirnames, fnames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if len(d) == 2]  # shards only
+            found.extend(os.path.join(dirpath, f) for f in fnames
+                         if self.keyname(f))
+        return found
+
+    @staticmethod
+    def keyname(fname):
+        'return True if fname looks like <key>.<ext>'
+        # but not <key>.<ext>.<ident>.tmp left by an interrupted write, nor
+        # the <key>.deferred lock of a background render, nor any path
+        if os.path.basename(fname) != fname or '/' in fname or \
+                os.sep in fname or (os.altsep and os.altsep in fname):
+            return False
+        key, dot, ext = fname.partition('.')
+        return bool(len(key) == 40 and dot and ext and
+                    all(c in '0123456789abcdef' for c in key) and
+                    ext.split('.')[-1] not in ('tmp', 'deferred'))
+
+
+class Remote(object):
+    'a remote, content-addressed cache of files named <key>.<ext>'
+    # Backends implement read(name) -> data or None if missing and
+    # write(name, data), raising OSError when the remote cannot be reached,
+    # and register themselves in backends by the scheme of their urls.
+    backends = {}             # url scheme -> Remote subclass
+    remotes = {}              # url -> Remote
+    lock = threading.Lock()
+    pool = 8                  # max concurrent requests to a remote
+    pause = 30                # seconds a remote is skipped after failing
+
+    @classmethod
+    def get(cls, url):
+        'return the remote cache for url'
+        with cls.lock:
+            if url not in cls.remotes:
+                scheme = urlsplit(url).scheme.lower()
+                if scheme not in cls.backends:
+                    raise ValueError('unknown im_cache scheme in %r' % url)
+                cls.remotes[url] = cls.backends[scheme](url)
+            return cls.remotes[url]
+
+    def __init__(self, url):
+        self.url = url
+        self.misses = set()   # names known to be missing
+        self.down = 0         # time until which the remote is skipped
+        self.lock = threading.Lock()
+
+    def fetch(self, name):
+        'return data for name, or None if missing or unavailable'
+        if self.down > time() or name in self.misses:
+            return None
+        try:
+            data = self.read(name)
+        except (OSError, IOError) as e:
+            self.unavailable(e)
+            return None
+        if data is None:
+            with self.lock:
+                self.misses.add(name)
+        return data
+
+    def store(self, name, data):
+        'upload data for name, return True on success'
+        if self.down > time():
+            return False
+        try:
+            self.write(name, data)
+        except (OSError, IOError) as e:
+            self.unavailable(e)
+            return False
+        with self.lock:
+            self.misses.discard(name)
+        return True
+
+    def unavailable(self, e):
+        'skip the remote for a while'
+        # a filter run is usually done by then, long running commands (like
+        # watch or serve) try again later
+        with self.lock:
+            if self.down > time():
+                return
+            self.down = time() + self.pause
+        print('Imagine: remote cache %s unavailable (%s), skipped for %ds' %
+              (self.url, e, self.pause), file=sys.stderr)
+
+
+class HTTPPool(object):
+    'a pool of keep-alive connections to an http(s) server, shared by threads'
+    # a token, if given, is sent as a bearer token.
+
+    def __init__(self, url, token=None, timeout=30, size=8):
+        parts = urlsplit(url if '://' in url else 'http://' + url)
+        self.https = parts.scheme.lower() == 'https'
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/') + '/'
+        self.headers = {}
+        if token:
+            self.headers['Authorization'] = 'Bearer %s' % token
+        self.timeout = timeout
+        self.size = size
+        self.idle = []        # pooled connections
+        self.lock = threading.Lock()
+
+    def request(self, method, name, body=None, ctype=None):
+        'return (status, body) of a response, reusing idle connections'
+        from http.client import HTTPConnection, HTTPSConnection, HTTPException
+        headers = dict(self.headers)
+        if ctype:
+            headers['Content-Type'] = ctype
+        for attempt in range(2):
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            pooled = conn is not None
+            if conn is None:
+                conncls = HTTPSConnection if self.https else HTTPConnection
+                conn = conncls(self.netloc, timeout=self.timeout)
+            try:
+                conn.request(method, self.prefix + quote(name), body=body,
+                             headers=headers)
+                rsp = conn.getresponse()
+                data = rsp.read()
+            except (HTTPException, OSError) as e:
+                conn.close()
+                if pooled:
+                    # the server may have closed idle connections (e.g. when
+                    # restarted), so drop them all and retry on a fresh one
+                    with self.lock:
+                        stale, self.idle = self.idle, []
+                    for conn in stale:
+                        conn.close()
+                    continue
+                raise IOError('%s %s: %s' % (method, name, e))
+            with self.lock:
+                if rsp.will_close or len(self.idle) >= self.size:
+                    conn.close()
+                else:
+                    self.idle.append(conn)
+            return rsp.status, data
+        raise IOError('%s %s: no connection' % (method, name))
+
+
+class HTTPRemote(Remote):
+    'a remote cache served over http(s), using GET and PUT on <url>/<name>'
+    # $IMAGINE_CACHE_TOKEN, if set, is sent as a bearer token.
+
+    def __init__(self, url):
+        super(HTTPRemote, self).__init__(url)
+        self.http = HTTPPool(url, os.environ.get('IMAGINE_CACHE_TOKEN'),
+                             size=self.pool)
+
+    def request(self, method, name, body=None):
+        'return (status, body) of a response'
+        return self.http.request(method, name, body)
+
+    def read(self, name):
+        'return data for name or None if missing'
+        status, data = self.request('GET', name)
+        if status == 404:
+            return None
+        if status != 200:
+            raise IOError('GET %s: HTTP %d' % (name, status))
+        return data
+
+    def write(self, name, data):
+        'upload data for name'
+        status, _ = self.request('PUT', name, to_bytes(data, 'utf-8'))
+        if status not in (200, 201, 204):
+            raise IOError('PUT %s: HTTP %d' % (name, status))
+
+
+class DirRemote(Remote):
+    'a remote cache in a (shared) directory, e.g. file:///mnt/imagine'
+
+    def __init__(self, url):
+        super(DirRemote, self).__init__(url)
+        self.root = urlsplit(url).path
+
+    def read(self, name):
+        'return data for name or None if missing'
+        try:
+            with open(os.path.join(self.root, name), 'rb') as f:
+                return f.read()
+        except (OSError, IOError):
+            if os.path.isdir(self.root):
+                return None
+            raise
+
+    def write(self, name, data):
+        'store data for name'
+        path = os.path.join(self.root, name)
+        tmpfile = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        with open(tmpfile, 'wb') as f:
+            f.write(to_bytes(data, 'utf-8'))
+        os.replace(tmpfile, path)
+
+
+Remote.backends.update(http=HTTPRemote, https=HTTPRemote, file=DirRemote)
+
+
+class Agents(object):
+    'dispatch render jobs to the least busy of some agents (see cmd_agent)'
+    # An agent that cannot be reached (or does not speak http/json) is
+    # skipped for a while.  One that lacks the tool for a job just passes it
+    # on to the next one; jobs no agent took are run locally.
+    timeout = 900             # seconds, for a job to complete
+    pause = 30                # seconds an agent is skipped after failing
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = {}       # url -> HTTPPool
+        self.busy = {}        # url -> jobs in flight
+        self.down = {}        # url -> time until which it is skipped
+
+    def pool(self, url):
+        'return the connection pool for an agent'
+        with self.lock:
+            if url not in self.pools:
+                self.pools[url] = HTTPPool(
+                    url, os.environ.get('IMAGINE_AGENT_TOKEN'),
+                    timeout=self.timeout, size=4)
+            return self.pools[url]
+
+    def order(self, urls):
+        'return agents that are up, least busy first'
+        now = time()
+        with self.lock:
+            up = [u for u in urls if self.down.get(u, 0) <= now]
+            random.shuffle(up)  # spread ties
+            return sorted(up, key=lambda u: self.busy.get(u, 0))
+
+    def run(self, urls, job):
+        'return (url, reply) of the agent that ran job, or (None, None)'
+        body = to_bytes(json.dumps(job))
+        for url in self.order(urls):
+            with self.lock:
+                self.busy[url] = self.busy.get(url, 0) + 1
+            try:
+                status, data = self.pool(url).request(
+                    'POST', 'run', body, 'application/json')
+                if status != 200:
+                    raise IOError('HTTP %d' % status)
+                reply = json.loads(to_str(data, 'utf-8'))
+            except (IOError, OSError, ValueError) as e:
+                print('Imagine: agent %s skipped (%s)' % (url, e),
+                      file=sys.stderr)
+                with self.lock:
+                    self.down[url] = time() + self.pause
+                continue
+            finally:
+                with self.lock:
+                    self.busy[url] -= 1
+            if 'error' in reply or reply.get('missing'):
+                # the agent is fine, it just cannot run this particular job
+                print('Imagine: agent %s passed on %s (%s)' % (
+                    url, job['argv'][0], reply.get('error') or to_str(
+                        base64.b64decode(reply['stderr']), 'utf-8').strip()),
+                      file=sys.stderr)
+                continue
+            return url, reply
+        return None, None
+
+
+agents = Agents()
+
+
+# A fork server is started by (possibly another) python interpreter with the
+# modules to preload as its arguments.  It reports which of those failed to
+# import and then reads jobs, one json line each, from stdin.  Each job is
+# run in a forked child so it starts out with all modules already imported
+# while jobs remain isolated from each other.  A job either runs a script
+# (argv[0]) or calls an entry point 'module:func', with entry_args if given.
+# Its reply is a json line with the child's returncode and resource usage.
+# A warmup job runs in the server itself, to take care of any lazy
+# initialisation before forking children.
+FORKSERVER = r'''
+import os, sys, json, runpy, importlib, traceback
+failed = {}
+for mod in sys.argv[1:]:
+    try:
+        importlib.import_module(mod)
+    except BaseException as e:
+        failed[mod] = str(e) or repr(e)
+sys.stdout.write(json.dumps({'failed': failed}) + '\n')
+sys.stdout.flush()
+
+def execute(job):
+    sys.argv = job['argv']
+    code = 0
+    try:
+        if job['entry']:
+            mod, func = job['entry'].split(':')
+            func = getattr(importlib.import_module(mod), func)
+            if job['entry_args'] is None:
+                code = func()
+            else:
+                code = func(job['entry_args'])
+        else:
+            sys.path[0] = os.path.dirname(os.path.abspath(job['argv'][0]))
+            runpy.run_path(job['argv'][0], run_name='__main__')
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    if code is not None and not isinstance(code, int):
+        sys.stderr.write('%s\n' % code)
+        code = 1
+    return code or 0
+
+def child(job):
+    if job.get('timeout'):
+        import signal
+        signal.setitimer(signal.ITIMER_REAL, job['timeout'])  # SIGALRM kills
+    os.chdir(job['cwd'])
+    os.environ.clear()
+    os.environ.update(job['env'])
+    # a spill file may still hold the output of an earlier run
+    out = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    for fd, name, flags in ((0, 'stdin', os.O_RDONLY), (1, 'stdout', out),
+                            (2, 'stderr', out)):
+        os.dup2(os.open(job[name] or os.devnull, flags, 0o600), fd)
+    code = execute(job)
+    try:
+        import atexit
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def warmup(job):
+    # run in the server itself, so lazy initialisations carry over to all
+    # children forked afterwards.
+    saved = sys.stdout, sys.stderr, sys.argv
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        return execute(job)
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr, sys.argv = saved
+
+for line in sys.stdin:
+    job = json.loads(line)
+    if job.get('warmup'):
+        code = warmup(job)
+        sys.stdout.write(json.dumps({'returncode': code}) + '\n')
+        sys.stdout.flush()
+        continue
+    pid = os.fork()
+    if pid == 0:
+        child(job)
+    _, status, ru = os.wait4(pid, 0)
+    if os.WIFSIGNALED(status):
+        code = -os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    sys.stdout.write(json.dumps({'returncode': code,
+                                 'cpu': ru.ru_utime + ru.ru_stime,
+                                 'rss': ru.ru_maxrss}) + '\n')
+    sys.stdout.flush()
+'''
+
+
+class ForkServer(object):
+    'a python interpreter with preloaded modules that forks a child per job'
+
+    def __init__(self, python, preload):
+        self.proc = Popen([python, '-c', FORKSERVER] + list(preload),
+                          stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        ready = self.proc.stdout.readline()
+        if not ready:
+            self.close()
+            raise OSError('fork server %r did not start' % python)
+        self.failed = json.loads(to_str(ready, 'utf-8'))['failed']
+
+    def run(self, job):
+        'run a job, return the reply of the server'
+        self.proc.stdin.write(to_bytes(json.dumps(job) + '\n', 'utf-8'))
+        self.proc.stdin.flush()
+        reply = self.proc.stdout.readline()
+        if not reply:
+            raise OSError('fork server died')
+        return json.loads(to_str(reply, 'utf-8'))
+
+    def close(self):
+        'stop the server'
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (OSError, IOError):
+            pass
+
+
+class ForkServers(object):
+    'pools of idle fork servers, by interpreter and preloaded modules'
+
+    def __init__(self):
+        self.idle = {}        # (python, preload) -> [ForkServer, ..]
+        self.broken = set()   # (python, preload) of servers that failed
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def run(self, python, preload, args, stdin=None, entry=None,
+            entry_args=None, required=(), warmup=None, cwd=None, env=None,
+            timeout=None, limits=None, spill=None):
+        'run args in a warm interpreter, like spawn() or None if impossible'
+        # Without an entry point ('module:func'), args[0] is run as a script.
+        # Preloading is best effort, except for the required modules.  A new
+        # server first calls the entry point with the warmup args, if any.
+        limits = limits or {}
+        key = (python, tuple(preload))
+        with self.lock:
+            if key in self.broken:
+                return None   # no use trying again, run as a command instead
+            servers = self.idle.setdefault(key, [])
+            server = servers.pop() if servers else None
+        try:
+            if server is None:
+                server = ForkServer(python, preload)
+                if warmup is not None and \
+                        not any(mod in server.failed for mod in required):
+                    server.run({'warmup': True, 'argv': list(args),
+                                'entry': entry, 'entry_args': warmup})
+        except (OSError, IOError, ValueError):
+            if server is not None:
+                server.close()
+            with self.lock:
+                self.broken.add(key)
+            return None
+        if any(mod in server.failed for mod in required):
+            with self.lock:
+                self.idle[key].append(server)
+            return None
+
+        tmpdir = tempfile.mkdtemp(prefix='imagine-')
+        try:
+            job = {'argv': list(args), 'entry': entry,
+                   'entry_args': entry_args, 'cwd': cwd or os.getcwd(),
+                   'env': env or dict(os.environ), 'stdin': None,
+                   'timeout': timeout,
+                   'stdout': spill or os.path.join(tmpdir, 'stdout'),
+                   'stderr': os.path.join(tmpdir, 'stderr')}
+            if stdin is not None:
+                job['stdin'] = os.path.join(tmpdir, 'stdin')
+                with open(job['stdin'], 'wb') as f:
+                    f.write(to_bytes(stdin))
+            try:
+                reply = server.run(job)
+            except (OSError, IOError, ValueError):
+                server.close()
+                with self.lock:
+                    self.broken.add(key)
+                return None
+            with self.lock:
+                self.idle[key].append(server)
+            if spill:
+                truncate(spill, limits.get('out'))
+                out = None
+            else:
+                with open(job['stdout'], 'rb') as f:
+                    out = capture(f, limits.get('out'))
+            with open(job['stderr'], 'rb') as f:
+                err = capture(f, limits.get('err'))
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+        scale = 1 if sys.platform == 'darwin' else 1024  # linux reports KB
+        usage = {'cpu': reply['cpu'], 'rss': reply['rss'] * scale}
+        return reply['returncode'], out, err, usage
+
+    def close(self):
+        'stop all idle servers'
+        with self.lock:
+            for servers in self.idle.values():
+                for server in servers:
+                    server.close()
+            self.idle.clear()
+
+
+forkservers = ForkServers()
+
 # Notes:
 # - if walker does not return anything, the element is kept
 # - if walker returns a block element, it'll replace current element
@@ -238,20 +1707,51 @@ class Handler(with_metaclass(HandlerMeta, object)):
     'baseclass for image/ascii art generators'
     severity = 'error warn note info debug'.split()
     workers = {}              # dispatch map for Handler, filled by HandlerMeta
-    klass = None              # __call__ dispatches a worker & sets this
-    meta = {}                 # stores user prefs in doc's meta yaml block
+    klass = None              # set per worker, by __call__ or render()
+    doc = None                # source document, if known
     cmdmap = {}               # worker subclass overrides, klass->cli-program
+    textual = False           # True for workers whose output is just text
+    products = []             # files, besides outfile, a cmd leaves in its
+                              #  working dir, e.g. '{key}.ps', to be kept
+    helpers = []              # programs run besides those in cmdmap
+    draft = []               # extra cli-options for cheaper drafts
+    html_fmts = set(['html', 'html4', 'html5', 'chunkedhtml', 'epub',
+                     'epub2', 'epub3', 'revealjs', 's5', 'slidy', 'slideous',
+                     'dzslides'])  # output formats that get im_dims
+    untracked = set(['im_budget', 'im_cache', 'im_cache_mode', 'im_dims',
+                     'im_dir', 'im_jobs', 'im_layout', 'im_ledger', 'im_log',
+                     'im_mem', 'im_placeholder', 'im_retry'])
+                              # options that do not affect running a cmd
     # FIXME: output became im_out
     output = 'img'            # output an img by default, some workers should
                               #  override this with stdout (eg Boxes, Figlet..)
 
     # Imagine defaults for worker options
+    im_cache = os.environ.get('IMAGINE_CACHE', '')  # remote cache, if any
+    im_budget = 0             # seconds a filter run may spend rendering
+    im_cache_mode = 'rw'      # ro only fetches from im_cache, rw also uploads
+    im_agents = os.environ.get('IMAGINE_AGENTS', '')  # csv-list, if any
+    im_dims = 0               # add width, height and lazy loading to images
+    im_draft = os.environ.get('IMAGINE_DRAFT', 0)  # cheaper, quicker renders
     im_dir = 'pd'             # dir for images (absolute or relative to cwd)
     im_fmt = 'png'            # default format for image creation
+    im_jobs = 0               # max parallel runs of this klass, 0 is no limit
+    im_layout = 'flat'        # flat, sharded or pack layout of im_dir-images
+    im_ledger = os.environ.get('IMAGINE_LEDGER', '')  # sqlite file, if any
     im_log = 0                # log on notification level
+    im_max_output = 1024 * 1024  # bytes of stdout/stderr kept, 0 for all
+    im_mem = 50               # memory (MB) one run is expected to claim
     im_opt = ''               # options to pass in to cli-program
     im_out = 'img'            # what to output: csv-list img,fcb,stdout,stderr
+    im_preload = ''           # modules a warm python interpreter imports
+    im_placeholder = ''       # text shown in place of a deferred render
     im_prg = None             # cli program to use to create graphic output
+    im_reproducible = 0       # normalize outputs to be byte-identical
+    im_retry = os.environ.get('IMAGINE_RETRY', 0)  # retry earlier failures
+    im_scratch = 0            # run commands in a scratch dir of their own
+    im_timeout = 0            # seconds a command may run, 0 is no limit
+    im_tmpdir = ''            # where to create scratch dirs, e.g. /dev/shm
+    im_warm = 0               # use warm python interpreters, if supported
 
     # im_out is an ordered csv-list of what to produce:
     # - 'img'    outputs a link to an image (if any was produced)
@@ -276,9 +1776,10 @@ class Handler(with_metaclass(HandlerMeta, object)):
         for klass in klasses:
             worker = self.workers.get(klass.lower(), None)
             if worker is not None:
-                worker.klass = klass.lower()
                 self.msg(4, '- dispatched by class to', worker)
-                return worker(codec, fmt, meta)
+                worker = worker(codec, fmt, meta, klass.lower())
+                worker.doc = self.doc
+                return worker
 
         # try dispatching via 'cmd' named by 'im_prg=cmd' key-value-pair
         if keyvals:  # pf.get_value barks if keyvals == []
@@ -286,18 +1787,22 @@ class Handler(with_metaclass(HandlerMeta, object)):
             worker = self.workers.get(prog.lower(), None)
             if worker is not None:
                 self.msg(4, codec[0], 'dispatched by prog to', worker)
-                return worker(codec, fmt,  meta)
+                worker = worker(codec, fmt,  meta, prog.lower())
+                worker.doc = self.doc
+                return worker
 
         self.msg(4, codec[0], 'dispatched by default to', self)
         return self
 
-    def __init__(self, codec, fmt, meta):
+    def __init__(self, codec, fmt, meta, klass=None):
         'init by decoding the CodeBlock-s value'
         self.codec = codec # save original codeblock for later
         self.fmt = fmt     # some workers (flydraw) need access to this
+        self.klass = klass # the codeblock class (or im_prg) that dispatched
 
         self.stdout = ''   # catches stdout by self.cmd, if any
         self.stderr = ''   # catches stderr by self.cmd, if any
+        self.stdout_file = None  # or where to read stdout from, on demand
 
         if codec is None:
             return         # initial dispatch creation
@@ -318,7 +1823,16 @@ class Handler(with_metaclass(HandlerMeta, object)):
         self.im_opt = self.im_opt.split()
         self.im_out = self.im_out.lower().replace(',', ' ').split()
         self.im_log = int(self.im_log)
+        self.im_jobs = int(self.im_jobs)
+        self.im_mem = int(self.im_mem)
+        self.im_budget = float(self.im_budget)
+        self.im_timeout = float(self.im_timeout or 0)
+        self.im_max_output = int(self.im_max_output)
         self.im_fmt = pf.get_extension(fmt, self.im_fmt)
+        self.im_retry = to_bool(self.im_retry)
+        self.im_draft = to_bool(self.im_draft)
+        if self.im_draft:
+            self.im_opt = self.im_opt + list(self.draft)
 
         if not self.im_prg:
             # if no im_prg was found, fallback to klass's cmdmap
@@ -328,13 +1842,201 @@ class Handler(with_metaclass(HandlerMeta, object)):
             self.msg(0, self.klass, 'not listed in', self.cmdmap)
             raise Exception('no worker found for %s' % self.klass)
 
-        self.basename = pf.get_filename4code(self.im_dir, str(codec))
+        try:
+            self.store = Store.get(self.im_dir, self.im_layout)
+        except ValueError as e:
+            self.msg(0, 'fail:', e, '(using flat)')
+            self.store = Store.get(self.im_dir)
+        self.remote = None
+        if self.im_cache and not self.im_draft:  # drafts are not shared
+            try:
+                self.remote = Remote.get(self.im_cache)
+            except ValueError as e:
+                self.msg(0, 'fail:', e)
+        self.key = self.keyof(codec, self.im_draft)
+        self.basename = self.store.basename(self.key)
         self.outfile = self.basename + '.%s' % self.im_fmt
         self.inpfile = self.basename + '.%s' % self.klass # _name.lower()
-
-        if not os.path.isfile(self.inpfile):
+        self.infofile = self.basename + '.info'
+
+        # options (and $PATH) that, besides the codeblock, shape the run
+        self.fingerprint = dict((opt, getattr(self, opt)) for opt in opts
+                                if opt not in self.untracked)
+        self.fingerprint['PATH'] = os.environ.get('PATH', '')
+        self.tools = {}      # prg -> tool_id(prg), for each cmd run
+        self.hit = False     # True if output was found in the cache
+        self.rendered = False  # True once a cmd succeeded in this run
+        self.published = False  # True once outfile was uploaded
+        self.deferred = False  # True if the render did not fit im_budget
+        self.cwd = None      # working dir of a running cmd, None for cwd
+        self.env = None      # environment for commands, None for os.environ
+        if to_bool(self.im_reproducible):
+            self.env = dict(os.environ, FORCE_SOURCE_DATE='1',
+                            SOURCE_DATE_EPOCH=os.environ.get(
+                                'SOURCE_DATE_EPOCH', '0'))
+        if self.im_draft:
+            self.env = dict(self.env or os.environ, IMAGINE_DRAFT='1')
+        self._info = None    # see self.info()
+
+        if not self.exists(self.inpfile):
             self.write('w', self.code, self.inpfile)
 
+    @staticmethod
+    def keyof(codec, draft=False):
+        'return the cache key of a codeblock'
+        # im_retry is left out, so it retries the very entry that failed;
+        # drafts get keys of their own, so final renders stay cached
+        (id_, classes, keyvals), code = codec
+        if any(k == 'im_retry' for k, v in keyvals):
+            keyvals = [[k, v] for k, v in keyvals if k != 'im_retry']
+            codec = [[id_, classes, keyvals], code]
+        return Store.key(str(codec) + (' im_draft' if draft else ''))
+
+    @property
+    def stdout(self):
+        'return stdout of self.cmd, reading it from stdout_file if need be'
+        if self._stdout is None:
+            self._stdout = self.read('r', self.stdout_file) \
+                if self.stdout_file and self.exists(self.stdout_file) else ''
+        return self._stdout
+
+    @stdout.setter
+    def stdout(self, data):
+        'set stdout, None to read it from stdout_file when needed'
+        self._stdout = data
+
+    def keep_stdout(self):
+        'keep stdout of a textual worker as its outfile, and vice versa'
+        # fresh output was spilled into outfile by cmd or still needs saving,
+        # while a cache hit is read back only if stdout is actually used
+        if self._stdout:
+            self.write('w', to_str(self._stdout, 'utf-8'), self.outfile)
+        else:
+            self.stdout_file = self.outfile
+            self.stdout = None
+
+    def packed(self, path):
+        'return name of path in the store\'s pack, if it belongs there'
+        if self.store.pack is None:
+            return None
+        if path == self.inpfile or (self.textual and path == self.outfile):
+            return os.path.basename(path)
+        return None
+
+    def exists(self, path):
+        'return True if path exists, as a file or in the store\'s pack'
+        name = self.packed(path)
+        if name:
+            return self.store.pack.entry(name) is not None
+        return os.path.isfile(path)
+
+    def size(self, path):
+        'return size of path, as a file or in the store\'s pack'
+        name = self.packed(path)
+        if name:
+            return (self.store.pack.entry(name) or (0, 0))[1]
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+
+    def unpack(self):
+        'write a packed inpfile to disk for a tool to read, return True if so'
+        if not self.packed(self.inpfile) or os.path.isfile(self.inpfile):
+            return False
+        data = self.store.pack.get(os.path.basename(self.inpfile))
+        with open(self.inpfile, 'wb') as f:
+            f.write(data or b'')
+        return True
+
+    def fetch(self):
+        'fetch outfile from the remote cache, return True if found'
+        if self.remote is None:
+            return False
+        name = os.path.basename(self.outfile)
+        data = self.remote.fetch(name)
+        if data is None:
+            return False
+        self.msg(3, 'fetched', name, 'from', self.remote.url)
+        if self.packed(self.outfile):
+            return self.write('wb', data, self.outfile)
+        # other threads or processes may be looking for outfile too
+        tmpfile = '%s.%s.tmp' % (self.outfile, threading.current_thread().ident)
+        if not self.write('wb', data, tmpfile):
+            return False
+        os.replace(tmpfile, self.outfile)
+        return True
+
+    def publish(self):
+        'upload a freshly rendered outfile to the remote cache, if allowed'
+        if self.remote is None or self.im_cache_mode != 'rw':
+            return
+        if not self.rendered or self.published or \
+                not self.exists(self.outfile):
+            return
+        self.published = True  # upload just once
+        name = os.path.basename(self.outfile)
+        if self.remote.store(name, self.read('rb', self.outfile)):
+            self.msg(3, 'uploaded', name, 'to', self.remote.url)
+
+    def info(self):
+        'return metadata stored for this codeblock, if any'
+        if self._info is None:
+            try:
+                with open(self.infofile, 'r') as f:
+                    self._info = json.load(f)
+            except (OSError, IOError, ValueError):
+                self._info = {}
+        return self._info
+
+    def set_info(self, **kwargs):
+        'update (a None value deletes) and save metadata for this codeblock'
+        info = self.info()
+        for key, val in kwargs.items():
+            if val is None:
+                info.pop(key, None)
+            else:
+                info[key] = val
+        try:
+            if not info:
+                if os.path.isfile(self.infofile):
+                    os.remove(self.infofile)
+                return
+            tmpfile = '%s.%s.tmp' % (self.infofile,
+                                     threading.current_thread().ident)
+            with open(tmpfile, 'w') as f:
+                json.dump(info, f, sort_keys=True)
+            os.replace(tmpfile, self.infofile)
+        except (OSError, IOError) as e:
+            self.msg(0, 'fail: could not save', self.infofile, repr(e))
+
+    def failed(self):
+        'return previous failure, unless its codeblock, options or tool changed'
+        rec = self.info().get('failed')
+        if not rec or self.im_retry:
+            return None
+        if rec.get('opts') != self.fingerprint:
+            return None
+        for prg, tid in rec.get('tools', {}).items():
+            if self.tool_id(prg) != tid:
+                return None
+        return rec
+
+    def tool_id(self, prg):
+        'return a fingerprint of the program a cmd runs, see tool_id'
+        return tool_id(prg)
+
+    def expected(self):
+        'return expected duration of rendering this codeblock'
+        return scheduler.expect(self.klass, self.info().get('durations'))
+
+    def fail(self, args, returncode):
+        'remember a failed command so later runs can replay it'
+        limit = 64 * 1024  # keep the info file reasonably small
+        self.set_info(failed={'args': list(args),
+                              'returncode': returncode,
+                              'opts': self.fingerprint,
+                              'tools': self.tools,
+                              'stdout': to_str(self.stdout, 'utf-8')[-limit:],
+                              'stderr': to_str(self.stderr, 'utf-8')[-limit:]})
+
     def get_md_opts(self, meta):
         'pickup user preferences from meta block'
         dct = {}
@@ -383,6 +2085,13 @@ class Handler(with_metaclass(HandlerMeta, object)):
 
     def read(self, mode, src):
         'read a file with given mode or return empty string'
+        name = self.packed(src)
+        if name:
+            dta = self.store.pack.get(name)
+            if dta is None:
+                self.msg(0, 'fail: could not read %s from pack' % name)
+                return ''
+            return dta if 'b' in mode else to_str(dta, 'utf-8')
         try:
             with open(src, mode) as f:
                 return f.read()
@@ -397,8 +2106,15 @@ class Handler(with_metaclass(HandlerMeta, object)):
             self.msg(3, 'skipped writing 0 bytes to', dst)
             return False
         try:
-            with open(dst, mode) as f:
-                f.write(dta)
+            name = self.packed(dst)
+            if name:
+                self.store.pack.put(name, dta)
+            else:
+                # other threads may be reading or writing dst as well
+                tmpfile = '%s.%s.tmp' % (dst, threading.current_thread().ident)
+                with open(tmpfile, mode) as f:
+                    f.write(dta)
+                os.replace(tmpfile, dst)
             self.msg(3, 'wrote:', len(dta), 'bytes to', dst)
         except (OSError, IOError) as e:
             self.msg(0, 'fail: could not write', len(dta), 'bytes to', dst)
@@ -420,9 +2136,44 @@ class Handler(with_metaclass(HandlerMeta, object)):
     def url(self):
         'return an image link for existing/new output image-file'
         # pf.Image is an Inline element. Callers usually wrap it in a pf.Para
-        return pf.Image([self.id_, self.classes, self.keyvals],
+        keyvals = self.keyvals
+        # only browsers benefit, elsewhere (latex) pixels would keep pandoc
+        # from fitting images to the line width
+        size = self.dims() if to_bool(self.im_dims) and \
+            self.fmt in self.html_fmts else None
+        if size and not any(k in ('width', 'height') for k, v in keyvals):
+            keyvals = keyvals + [['width', str(size[0])],
+                                 ['height', str(size[1])]]
+            if not any(k == 'loading' for k, v in keyvals):
+                keyvals.append(['loading', 'lazy'])
+        return pf.Image([self.id_, self.classes, keyvals],
                         self.caption, [self.outfile, self.typef])
 
+    def dims(self):
+        'return (width, height) of outfile, read once and kept in the info'
+        try:
+            st = os.stat(self.outfile)
+        except OSError:
+            return None
+        stamp = [st.st_size, st.st_mtime_ns]
+        dims = self.info().get('dims')
+        if dims and dims[2:] == stamp:
+            return dims[:2]  # unchanged since last time
+        size = image_size(self.outfile)
+        if size is None:
+            return None
+        self.set_info(dims=list(size) + stamp)
+        return list(size)
+
+    def placeholder(self):
+        'return a paragraph standing in for a deferred render, or None'
+        if not self.im_placeholder:
+            return None  # keeps the original codeblock
+        # not str.format: the text may well hold other braces (latex, json)
+        text = self.im_placeholder.replace('{klass}', self.klass or '')
+        text = text.replace('{key}', self.key)
+        return pf.Para([pf.Str(text)])
+
     def anon_codeblock(self):
         'reproduce the original CodeBlock inside an anonymous CodeBlock'
         (id_, klasses, keyvals), code = self.codec
@@ -437,6 +2188,12 @@ class Handler(with_metaclass(HandlerMeta, object)):
 
     def result(self):
         'return FCB, Para(url()) and/or CodeBlock(stdout) as ordered'
+        if self.rendered and to_bool(self.im_reproducible) and \
+                not self.im_draft and os.path.isfile(self.outfile):
+            if normalize(self.outfile, int(self.env['SOURCE_DATE_EPOCH']),
+                         self.key):
+                self.msg(3, 'normalized', self.outfile)
+        self.publish()
         rv = []
         enc = sys.getdefaultencoding()  # result always unicode
         for output_elm in self.im_out:
@@ -476,18 +2233,66 @@ class Handler(with_metaclass(HandlerMeta, object)):
         forced = kwargs.get('forced', False)  # no need to pop
         stdin = kwargs.get('stdin', None)
 
-        if os.path.isfile(self.outfile) and forced is False:
+        if forced is False and (self.exists(self.outfile) or self.fetch()):
             self.msg(4, 're-use: {!r}'.format(self.outfile))
+            if not self.hit:
+                self.hit = True
+                self.account(args[0], hit=True, ok=True)
             return True
 
+        self.tools[args[0]] = self.tool_id(args[0])
+        failure = None if forced else self.failed()
+        if failure:
+            # replay the diagnostics of a known failure, rather than rerun it
+            self.stdout = failure.get('stdout', '')
+            self.stderr = failure.get('stderr', '')
+            for line in self.stderr.splitlines():
+                self.msg(1, '<stderr>', line)
+            self.msg(1, 'fail:', *failure['args'])
+            self.msg(1, 'msg:', 'failed before with exit code',
+                     failure['returncode'], '(use im_retry=1 to retry)')
+            return False
+
+        if not budget.allows(self.im_budget, self.expected()):
+            self.msg(1, 'deferred:', self.klass, os.path.basename(
+                self.basename), 'im_budget of', self.im_budget, 's used up')
+            self.deferred = True
+            budget.defer(self)
+            return False
+
         try:
             self.msg(4, 'exec: ', *args)
-            pipes = {'stdin': None if stdin is None else PIPE,
-                     'stdout': PIPE,
-                     'stderr': PIPE}
-            p = Popen(args, **pipes)
-
-            out, err = p.communicate(to_bytes(stdin))
+            unpacked = self.unpack()
+            if args[0] == self.inpfile:
+                mode = os.stat(self.inpfile).st_mode
+                os.chmod(self.inpfile, stat.S_IEXEC | mode)
+            try:
+                started = time()
+                rv = self.run_remote(args, stdin)
+                if rv is None:
+                    with scheduler.slot(self.klass, self.im_jobs,
+                                        self.im_mem * 1024 * 1024,
+                                        self.expected()), \
+                            self.scratch(args) as args:
+                        started = time()
+                        rv = self.run(args, stdin)
+                elapsed = time() - started
+            finally:
+                if unpacked:
+                    os.remove(self.inpfile)
+            returncode, out, err, usage = rv
+            if out is None:
+                # stdout went straight into (what now is) the outfile, which
+                # is kept only if the command succeeded
+                self.stdout_file = self.outfile
+                if returncode != 0:
+                    out = self.read('rb', self.outfile)
+                    os.remove(self.outfile)
+            timedout = returncode < 0 and 0 < self.im_timeout <= elapsed
+            if timedout:
+                err = to_bytes(err) + to_bytes(
+                    'Imagine: killed after im_timeout of %ss\n' %
+                    self.im_timeout)
             self.stdout = out
             self.stderr = err
 
@@ -503,9 +2308,9 @@ class Handler(with_metaclass(HandlerMeta, object)):
                 self.msg(4, '<stderr>', 'no output seen')
 
             # STDOUT
-            if self.stdout:
-                self.msg(4, '<stdout>',
-                    'saw {} bytes'.format(len(self.stdout)))
+            size = len(out) if out is not None else self.size(self.outfile)
+            if size:
+                self.msg(4, '<stdout>', 'saw {} bytes'.format(size))
             else:
                 self.msg(4, '<stdout>', 'no output seen')
 
@@ -515,7 +2320,21 @@ class Handler(with_metaclass(HandlerMeta, object)):
                 # which is added to the document's AST
                 self.msg(4, 'created: {!r}'.format(self.outfile))
 
-            return p.returncode == 0
+            self.account(args[0], hit=False, ok=returncode == 0,
+                         wall=elapsed, **usage)
+            if returncode < 0:
+                pass  # killed (timeout, oom), may succeed later: not remembered
+            elif returncode != 0:
+                self.fail(args, returncode)
+            else:
+                # remember how long this took, for scheduling the next time
+                self.rendered = True
+                scheduler.learn(self.klass, elapsed)
+                durations = self.info().get('durations', {})
+                durations[os.path.basename(args[0])] = round(elapsed, 3)
+                self.set_info(failed=None, durations=durations)
+
+            return returncode == 0
 
         except (OSError, CalledProcessError) as e:
             try:
@@ -524,8 +2343,159 @@ class Handler(with_metaclass(HandlerMeta, object)):
                 pass
             self.msg(1, 'fail:', *args)
             self.msg(1, 'msg:', self.im_prg, str(e))
+            self.stderr = str(e)
+            self.account(args[0], hit=False, ok=False)
+            self.fail(args, None)
             return False
 
+    def run(self, args, stdin=None):
+        'run a command, return (returncode, stdout, stderr, usage)'
+        return spawn(args, stdin, timeout=self.im_timeout,
+                     limits=self.limits(), spill=self.spill(), cwd=self.cwd,
+                     env=self.env)
+
+    def limits(self):
+        'return max bytes of stdout & stderr to keep, see spawn'
+        # stdout of most non-textual tools is their (binary) output
+        limit = self.im_max_output or None
+        text = self.textual or 'stdout' in self.im_out
+        return {'out': limit if text else None, 'err': limit}
+
+    def spill(self):
+        'return where a textual tool should write its stdout as it arrives'
+        # i.e. the outfile in its working dir, to be collected into the cache
+        if not self.textual or self.packed(self.outfile):
+            return None
+        return os.path.join(self.cwd or os.getcwd(),
+                            os.path.basename(self.outfile))
+
+    @contextmanager
+    def scratch(self, args):
+        'yield args to run in a scratch dir (as self.cwd), keep its products'
+        # so tools that litter their working dir can run in parallel. Inputs
+        # are passed by absolute path, outfile is created in the scratch dir
+        # and (like any products) moved into the cache when done.
+        if not to_bool(self.im_scratch):
+            yield args
+            self.collect(os.getcwd())
+            return
+        self.cwd = tempfile.mkdtemp(prefix='imagine-',
+                                    dir=self.im_tmpdir or None)
+        try:
+            mapped = []
+            for idx, arg in enumerate(args):
+                if arg == self.outfile:
+                    arg = os.path.join(self.cwd, os.path.basename(arg))
+                elif (idx > 0 or arg == self.inpfile) and \
+                        not os.path.isabs(arg) and os.path.exists(arg):
+                    arg = os.path.abspath(arg)
+                mapped.append(arg)
+            yield mapped
+            self.collect(self.cwd)
+        finally:
+            shutil.rmtree(self.cwd, True)
+            self.cwd = None
+
+    def product_names(self):
+        'return names of the files a cmd may produce for the cache'
+        names = [os.path.basename(self.outfile)]
+        names.extend(p.format(key=self.key, im_fmt=self.im_fmt)
+                     for p in self.products)
+        return names
+
+    def collect(self, tmpdir):
+        'move outfile and any products from a working dir into the cache'
+        for name in self.product_names():
+            src = os.path.join(tmpdir, name)
+            dst = os.path.join(os.path.dirname(self.basename), name)
+            if src == dst or not os.path.isfile(src):
+                continue
+            self.msg(4, 'moving', src, dst)
+            try:
+                os.replace(src, dst)
+            except OSError:
+                # e.g. from tmpfs, copy next to dst first to stay atomic
+                shutil.copyfile(src, dst + '.tmp')
+                os.replace(dst + '.tmp', dst)
+
+    def run_remote(self, args, stdin=None):
+        'run a command on an agent, return like spawn() or None if none did'
+        urls = self.im_agents.replace(',', ' ').split()
+        if not urls:
+            return None
+        # Agents run jobs in a scratch dir, so paths are sent relative to the
+        # working dir, if possible, or else relative to 'imagine-images'.
+        root = os.path.relpath(self.store.root)
+        there = root if not root.startswith('..') else 'imagine-images'
+        root = self.store.root
+
+        def encode(data):
+            'return data as base64 text'
+            return to_str(base64.b64encode(to_bytes(data, 'utf-8')))
+
+        files = {}
+        for arg in [self.inpfile] + list(args):
+            if arg == self.inpfile:
+                data = self.read('rb', arg).replace(to_bytes(root),
+                                                    to_bytes(there))
+                files[arg.replace(root, there, 1)] = encode(data)
+            elif os.path.isfile(arg) and (arg.startswith(root) or not (
+                    os.path.isabs(arg) or arg.startswith('..'))):
+                with open(arg, 'rb') as f:
+                    files[arg.replace(root, there, 1)] = encode(f.read())
+        job = {'argv': [a.replace(root, there) for a in args],
+               'stdin': None if stdin is None else encode(stdin),
+               'files': files,
+               'outputs': [self.outfile.replace(root, there, 1)],
+               'env': dict((k, v) for k, v in (self.env or {}).items()
+                           if k not in os.environ or os.environ[k] != v),
+               'klass': self.klass, 'im_jobs': self.im_jobs,
+               'im_mem': self.im_mem, 'timeout': self.im_timeout,
+               'limits': self.limits(), 'expected': self.expected()}
+        url, reply = agents.run(urls, job)
+        if reply is None:
+            self.msg(3, 'no agent took', args[0], 'running it locally')
+            return None
+
+        self.msg(3, 'ran', args[0], 'on agent', url)
+        for name, data in reply.get('files', {}).items():
+            if os.path.isabs(name) or '..' in name.split('/'):
+                self.msg(1, 'fail: agent', url, 'returned', name)
+                continue
+            if name == there or name.startswith(there + '/'):
+                name = root + name[len(there):]
+            elif name in self.product_names():
+                name = os.path.join(os.path.dirname(self.basename), name)
+            self.write('wb', base64.b64decode(data), name)
+        return (reply['returncode'], base64.b64decode(reply['stdout']),
+                base64.b64decode(reply['stderr']), reply.get('usage', {}))
+
+    def run_warm(self, python, args, stdin=None, preload=(), **kwargs):
+        'run python code in a warm interpreter if possible, else run args'
+        # see ForkServers.run for the keyword arguments
+        if python and to_bool(self.im_warm):
+            preload = list(preload) + self.im_preload.replace(',', ' ').split()
+            rv = forkservers.run(python, preload, args, stdin, cwd=self.cwd,
+                                 env=self.env, timeout=self.im_timeout,
+                                 limits=self.limits(), spill=self.spill(),
+                                 **kwargs)
+            if rv is not None:
+                return rv
+            self.msg(3, 'no warm', python, 'for', args[0])
+        return Handler.run(self, args, stdin)
+
+    def account(self, tool, hit, ok, wall=0.0, cpu=None, rss=None):
+        'record a render or cache hit in the ledger, if one is kept'
+        if not self.im_ledger:
+            return
+        if tool.startswith(self.basename):
+            tool = self.im_prg  # e.g. a shebang runs its own inpfile
+        Ledger.get(self.im_ledger).record(
+            klass=self.klass, tool=os.path.basename(tool),
+            key=os.path.basename(self.basename), doc=self.doc, hit=hit, ok=ok,
+            wall=wall, cpu=cpu, rss=rss, insize=self.size(self.inpfile),
+            outsize=self.size(self.outfile))
+
     def image(self):
         'return an Image url or None to keep CodeBlock'
         # For cases where no handler could be associated with a fenced
@@ -543,7 +2513,9 @@ class Asy(Handler):
     See http://asymptote.sourceforge.net/
     '''
     cmdmap = {'asy': 'asy', 'asymptote': 'asy'}
+    draft = ['-antialias', '1', '-render', '1']
     im_fmt = 'png'
+    im_mem = 150
 
     def image(self):
         'asy -o <fname>.{im_fmt} {im_opt} <fname>.asy'
@@ -558,6 +2530,7 @@ class Boxes(Handler):
     http://boxes.thomasjensen.com
     '''
     cmdmap = {'boxes': 'boxes'}
+    textual = True
     im_fmt = 'boxed'
     output = 'stdout'  # i.e. default to stdout
 
@@ -568,10 +2541,7 @@ class Boxes(Handler):
         self.im_out = [x for x in self.im_out if x not in ['img']]
         args = self.im_opt + [self.inpfile]
         if self.cmd(self.im_prg, *args):
-            if self.stdout:
-                self.write('w', to_str(self.stdout), self.outfile)
-            else:
-                self.stdout = self.read('r', self.outfile)
+            self.keep_stdout()
             return self.result()
 
 
@@ -582,6 +2552,8 @@ class BlockDiag(Handler):
     '''
     progs = 'blockdiag seqdiag rackdiag nwdiag packetdiag actdiag'.split()
     cmdmap = dict(zip(progs, progs))
+    im_warm = 1        # call {im_prg}.command:main in a warm interpreter
+    im_preload = 'PIL.Image,PIL.ImageDraw,PIL.ImageFont'
 
     def image(self):
         '{im_prg} {im_opt} -T {im_fmt} <fname>.{im_fmt} -o <fname>.{im_prg}'
@@ -589,6 +2561,21 @@ class BlockDiag(Handler):
         if self.cmd(self.im_prg, *args):
             return self.result()
 
+    def run(self, args, stdin=None):
+        'call the entry point in a warm interpreter, or run the command'
+        # a single pool of interpreters serves the whole family, a new one
+        # warms up by rendering this diagram to /dev/null first
+        module = '%s.command' % os.path.basename(args[0])
+        python = script_python(args[0]) or sys.executable
+        outname = os.path.basename(self.outfile)
+        warmup = [os.devnull if os.path.basename(a) == outname else a
+                  for a in args[1:]]
+        return self.run_warm(python, args, stdin,
+                             preload=['%s.command' % p for p in self.progs],
+                             entry=module + ':main',
+                             entry_args=list(args[1:]),
+                             required=[module], warmup=warmup)
+
 
 class Ctioga2(Handler):
     '''
@@ -611,6 +2598,8 @@ class Ditaa(Handler):
     http://ditaa.sourceforge.net
     '''
     cmdmap = {'ditaa': 'ditaa'}
+    draft = ['--no-antialias', '--no-shadows']
+    im_mem = 250     # a jvm
 
     def image(self):
         'ditaa <fname>.ditaa <fname>.{im_fmt} {im_opt}'
@@ -627,6 +2616,7 @@ class Figlet(Handler):
     # - saves code-text to <fname>.figlet
     # - saves stdout to <fname>.figled
     cmdmap = {'figlet': 'figlet'}
+    textual = True
     im_fmt = 'figled'
 
     def image(self):
@@ -636,11 +2626,8 @@ class Figlet(Handler):
 
         args = self.im_opt
         if self.cmd(self.im_prg, stdin=self.code, *args):
-            if self.stdout:
-                # save figlet's stdout to outfile for next time around
-                self.write('w', to_str(self.stdout), self.outfile)
-            else:
-                self.stdout = self.read('r', self.outfile)
+            # figlet's stdout is its outfile, for next time around
+            self.keep_stdout()
             return self.result()
 
 
@@ -762,6 +2749,9 @@ class Graphviz(Handler):
     progs = ['dot', 'neato', 'twopi', 'circo', 'fdp', 'sfdp']
     cmdmap = dict(zip(progs, progs))
     cmdmap['graphviz'] = 'dot'
+    # lower resolution and fewer layout iterations
+    draft = ['-Gdpi=48', '-Gnslimit=2', '-Gnslimit1=2', '-Gmclimit=0.5',
+             '-Gmaxiter=100', '-Gsearchsize=10']
     im_fmt = 'svg'  # override Handler's png default
 
     def image(self):
@@ -783,7 +2773,7 @@ class Gri(Handler):
     - ImageMagick's security policy might need massaging
     '''
     # cannot convince gri to output intermediate ps in pd-images/..
-    # so we move it there.
+    # so it is declared as a product, which cmd moves there.
     # Repair ImageMagick's ability to manipulate ps files:
     # nvim /etc/ImageMagick-6/policy.xml
     #  <policy domain="coder" rights="read|write" pattern="PS" />
@@ -794,19 +2784,17 @@ class Gri(Handler):
     #  <policy domain="coder" rights="read|write" pattern="XPS" />
 
     cmdmap = {'gri': 'gri'}
+    products = ['{key}.ps']  # gri insists on producing a .ps in its cwd
+    helpers = ['convert']
 
     def image(self):
         'gri {im_opt} -c 0 -b <fname>.gri'
         # -> <x>.ps -> <x>.{im_fmt} -> Para(Img(<x>.{im_fmt}))'
         args = self.im_opt + ['-c', '0', '-b', self.inpfile]
         if self.cmd(self.im_prg, *args):
-            # gri insists on producing a .ps in current working dir
-            dstfile = self.inpfile.replace('.gri', '.ps')
-            srcfile = os.path.split(dstfile)[-1]   # the temp ps in working dir
-            if os.path.isfile(srcfile):
-                self.msg(3, 'moving', srcfile, dstfile)
-                os.rename(srcfile, dstfile)
-            if self.cmd('convert', dstfile, self.outfile):
+            density = ['-density', '36'] if self.im_draft else []
+            if self.cmd('convert', *density + [self.basename + '.ps',
+                                               self.outfile]):
                 return self.result()
             else:
                 self.msg(2, "could not convert gri's ps to", self.im_fmt)
@@ -877,6 +2865,8 @@ class Mermaid(Handler):
     https://github.com/mermaidjs/mermaid.cli
     '''
     cmdmap = {'mermaid': 'mmdc'}
+    im_jobs = 2      # each run starts a headless chromium
+    im_mem = 400
 
     def image(self):
         'mmdc -i <fname>.mermaid -o <fname>.<fmt> {im_opt}'
@@ -906,6 +2896,7 @@ class Octave(Handler):
     https://www.gnu.org/software/octave
     '''
     cmdmap = {'octave': 'octave'}
+    im_mem = 200
 
     def image(self):
         'octage --no-gui -q {im_opt} <fname>.octave <fname>.{im_fmt}'
@@ -938,6 +2929,9 @@ class PlantUml(Handler):
     http://plantuml.com
     '''
     cmdmap = {'plantuml': 'plantuml'}
+    draft = ['-Sdpi=48']
+    im_jobs = 2      # each run starts a jvm
+    im_mem = 300
 
     def image(self):
         'plantuml -t{im_fmt} <fname>.plantuml {im_opt}'
@@ -992,6 +2986,8 @@ class Protocol(Handler):
     https://github.com/luismartingarcia/protocol.git
     '''
     cmdmap = {'protocol': 'protocol'}
+    textual = True
+    im_warm = 1        # run the protocol script in a warm interpreter
     im_fmt = 'protocold'
     output = 'stdout'  # i.e. default to stdout
 
@@ -1001,12 +2997,15 @@ class Protocol(Handler):
         # silently ignore any request for an 'image'
         self.im_out = [x for x in self.im_out if x not in ['img']]
         if self.cmd(self.im_prg, *args):
-            if self.stdout:
-                self.write('w', to_str(self.stdout), self.outfile)
-            else:
-                self.stdout = self.read('r', self.outfile)
+            self.keep_stdout()
             return self.result()
 
+    def run(self, args, stdin=None):
+        'run the protocol script in a warm interpreter, or run the command'
+        script = shutil.which(args[0]) or args[0]
+        return self.run_warm(script_python(args[0]),
+                             [script] + list(args[1:]), stdin)
+
 
 class PyxPlot(Handler):
     '''
@@ -1018,8 +3017,10 @@ class PyxPlot(Handler):
     def image(self):
         'pyxplot {im_opt} <fname>.pyxplot'
         args = self.im_opt + [self.inpfile]
+        # output goes to its working dir, cmd moves it into the cache
         self.code = '%s\n%s\n%s' % ('set terminal %s' % self.im_fmt,
-                                    'set output %s' % self.outfile,
+                                    'set output %s' % (
+                                        os.path.basename(self.outfile)),
                                     self.code)
         self.write('w', self.code, self.inpfile)
         if self.cmd(self.im_prg, *args):
@@ -1035,27 +3036,1310 @@ class SheBang(Handler):
 
     def image(self):
         '<fname>.shebang {im_opt} <fname>.{im_fmt}'
-        os.chmod(self.inpfile, stat.S_IEXEC | os.stat(self.inpfile).st_mode)
+        # cmd makes the inpfile executable, since that's what it runs
         args = self.im_opt + [self.outfile]
         if self.cmd(self.inpfile, *args):
             return self.result()
 
+    def run(self, args, stdin=None):
+        'run a python script in a warm interpreter, if so requested'
+        line = self.code.splitlines()[0] if self.code else ''
+        return self.run_warm(shebang_python(line), args, stdin)
+
+    def tool_id(self, prg):
+        'return a fingerprint of the #!-line interpreter, not the script'
+        line = self.code.splitlines()[0] if self.code else ''
+        words = line[2:].split() if line.startswith('#!') else []
+        if words and os.path.basename(words[0]) == 'env':
+            words = words[1:]
+        return tool_id(words[0]) if words else None
+
 # use sys.modules[__name__].__doc__ instead of __doc__ directly
 # to avoid pylint'rs complaints.
 sys.modules[__name__].__doc__ %= \
     {'cmds': '\n    '.join(wrap(', '.join(sorted(Handler.workers.keys()))))}
 
+
+#-- api
+RenderResult = namedtuple('RenderResult',
+                          'ok path data stdout stderr cached key')
+inflight = {}                 # outfile -> Future of its RenderResult
+inflight_lock = threading.Lock()
+
+
+def render(klass, code, fmt='', meta=None, **opts):
+    'render code as a codeblock of given klass, return a RenderResult'
+    # Keyword arguments are the codeblock's attributes, like im_fmt='svg' or
+    # width='50%', so results are cached just like those of the filter:
+    #   render('dot', 'digraph { a -> b }', im_fmt='svg')
+    #   == ```{.dot im_fmt="svg"}
+    #      digraph { a -> b }
+    #      ```
+    # Safe to call from many threads: workers keep all their state and share
+    # the cache, scheduler and warm interpreters, while identical renders in
+    # progress are shared (see render_shared).  A result has:
+    # - ok,     True if its command(s) succeeded (or it was found in cache)
+    # - path,   of the output file, if any
+    # - data,   contents of the output file, if any (as bytes)
+    # - stdout, stderr as produced by the command (text)
+    # - cached, True if it came out of the cache
+    # - key,    the cache key
+    return render_shared(klass, code, fmt, meta, **opts)[0]
+
+
+def render_shared(klass, code, fmt='', meta=None, **opts):
+    'like render, return (RenderResult, True if another call rendered it)'
+    # calls for the same outfile wait for the first one, rather than run the
+    # same tool into the same file at the same time
+    cls = Handler.workers.get(klass.lower())
+    if cls is None or cls is Imagine:
+        raise ValueError('no worker for klass %r' % klass)
+    keyvals = [[k, to_str(v)] for k, v in sorted(opts.items())]
+    codec = [['', [klass], keyvals], code]
+    worker = cls(codec, fmt, meta or {}, klass.lower())
+    with inflight_lock:
+        future = inflight.get(worker.outfile)
+        owner = future is None
+        if owner:
+            future = inflight[worker.outfile] = Future()
+    if not owner:
+        return future.result(), True
+    try:
+        future.set_result(render_worker(worker))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with inflight_lock:
+            del inflight[worker.outfile]
+    return future.result(), False
+
+
+def render_worker(worker):
+    'render the codeblock of a worker, return its RenderResult'
+    worker.image()
+    ok = (worker.hit or worker.rendered) and not worker.info().get('failed')
+    path = worker.outfile if worker.exists(worker.outfile) else None
+    data = worker.read('rb', path) if path else None
+    return RenderResult(ok=ok, path=path, data=data,
+                        stdout=to_str(worker.stdout, 'utf-8'),
+                        stderr=to_str(worker.stderr, 'utf-8'),
+                        cached=worker.hit, key=worker.key)
+
+
+#-- commands
+def read_doc(fname, reader=None):
+    'return pandoc json AST for a document or None on failure'
+    if fname == '-':
+        return json.load(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8'))
+    if fname.lower().endswith('.json'):
+        try:
+            with open(fname, 'rb') as f:
+                return json.loads(to_str(f.read(), 'utf-8'))
+        except (OSError, IOError, ValueError) as e:
+            print('Imagine: cannot read %s (%s)' % (fname, e), file=sys.stderr)
+            return None
+
+    args = ['pandoc', '-t', 'json', fname]
+    if reader:
+        args[1:1] = ['-f', reader]
+    try:
+        p = Popen(args, stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+    except OSError as e:
+        print('Imagine: cannot run pandoc (%s)' % e, file=sys.stderr)
+        return None
+    if p.returncode != 0:
+        print('Imagine: pandoc failed on %s' % fname, file=sys.stderr)
+        for line in err.splitlines():
+            print('>>: %s' % to_str(line), file=sys.stderr)
+        return None
+    return json.loads(to_str(out, 'utf-8'))
+
+
+def codeblocks(doc):
+    'return the CodeBlock values and the metadata of a pandoc json AST'
+    if isinstance(doc, dict):
+        meta = doc.get('meta', {})
+    else:
+        meta = doc[0]['unMeta']  # old API
+    found = []
+
+    def collect(key, value, fmt, meta):
+        'collect CodeBlocks, keep the AST as-is'
+        if key == 'CodeBlock':
+            found.append(value)
+
+    pf.walk(doc, collect, '', meta)
+    return found, meta
+
+
+def workers4doc(fname, fmt='', reader=None):
+    'return workers for the dispatchable codeblocks of a document, or None'
+    doc = read_doc(fname, reader)
+    if doc is None:
+        return None
+    blocks, meta = codeblocks(doc)
+    dispatch = Handler(None, None, None)
+    dispatch.doc = fname
+    workers = []
+    for codec in blocks:
+        try:
+            worker = dispatch(codec, fmt, meta)
+        except Exception as e:
+            dispatch.msg(0, fname, 'skipped codeblock:', e)
+            continue
+        if worker.__class__ in (Handler, Imagine):
+            continue  # not for us, or nothing to render
+        workers.append(worker)
+    return workers
+
+
+def workers4docs(fnames, fmt='', reader=None):
+    'return list of workers for all dispatchable codeblocks, deduplicated'
+    # keyed by outfile, which is derived from the codeblock's hash so
+    # identical codeblocks in different documents share a single worker.
+    jobs, count = {}, 0
+    for fname in fnames:
+        for worker in workers4doc(fname, fmt, reader) or []:
+            count += 1
+            jobs.setdefault(worker.outfile, worker)
+    return list(jobs.values()), count
+
+
+def keys4docs(fnames, reader=None):
+    'return cache keys of the dispatchable codeblocks of documents'
+    # like workers4docs, but without creating workers (which write inpfiles)
+    keys = set()
+    for fname in fnames:
+        doc = read_doc(fname, reader)
+        if doc is None:
+            continue
+        for codec in codeblocks(doc)[0]:
+            _, klasses, keyvals = codec[0]
+            prog = dict(keyvals).get('im_prg') or ''
+            if any(k.lower() in Handler.workers for k in klasses) or \
+                    prog.lower() in Handler.workers:
+                keys.add(Handler.keyof(codec))
+                keys.add(Handler.keyof(codec, draft=True))
+    return keys
+
+
+def expand(patterns):
+    'return filenames matching some (recursive) glob patterns'
+    fnames = []
+    for pattern in patterns:
+        fnames.extend(sorted(glob.glob(pattern, recursive=True)) or [pattern])
+    return fnames
+
+
+def prefetch(workers):
+    'fetch missing outputs from remote caches concurrently, return # found'
+    todo = [w for w in workers if w.remote and not w.exists(w.outfile)]
+    if not todo:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(len(todo), Remote.pool)) as pool:
+        return sum(pool.map(lambda w: w.fetch(), todo))
+
+
+def cmd_render(argv):
+    'pre-render all codeblocks of given documents into the cache'
+    ap = argparse.ArgumentParser(
+        prog='pandoc-imagine render',
+        description='render codeblocks of documents into {im_dir}-images')
+    ap.add_argument('files', nargs='+',
+                    help="markdown (or other pandoc input) or json documents, "
+                         "'-' reads json from stdin")
+    ap.add_argument('-f', '--from', dest='reader', default=None,
+                    help="pandoc's input format, if it cannot guess")
+    ap.add_argument('-t', '--to', dest='fmt', default='',
+                    help='output format the documents are intended for')
+    ap.add_argument('-j', '--jobs', type=int, default=scheduler.cpus,
+                    help='max number of renders to run in parallel')
+    ap.add_argument('-l', '--log', type=int, default=Handler.im_log,
+                    help='default im_log level')
+    ap.add_argument('-d', '--draft', action='store_true',
+                    help='default to im_draft=1')
+    ap.add_argument('-r', '--retry', action='store_true',
+                    help='default to im_retry=1, rerun earlier failures')
+    args = ap.parse_args(argv)
+    Handler.im_log = args.log
+    Handler.im_draft = args.draft or Handler.im_draft
+    Handler.im_retry = args.retry or Handler.im_retry
+    scheduler.cpus = max(1, args.jobs)
+
+    fnames = expand(args.files)
+    workers, count = workers4docs(fnames, args.fmt, args.reader)
+    fetched = prefetch(workers)
+    todo = []
+    for w in workers:
+        if w.exists(w.outfile):
+            budget.release(w)  # e.g. rendered by some other process
+        else:
+            todo.append(w)
+    todo.sort(key=lambda w: w.expected(), reverse=True)
+
+    def image(w):
+        'render a codeblock, releasing it if deferred by a filter run'
+        try:
+            return w.image()
+        finally:
+            budget.release(w)
+
+    # the scheduler decides what actually runs, so supply enough threads for
+    # it to choose from when some klass is at its limit
+    threads = max(1, min(len(todo), 4 * scheduler.cpus + 16))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        failed = sum(1 for rv in pool.map(image, todo) if rv is None)
+
+    print('Imagine: %d docs, %d codeblocks, %d unique, %d cached, '
+          '%d fetched, %d rendered, %d failed' % (
+              len(fnames), count, len(workers),
+              len(workers) - len(todo) - fetched, fetched,
+              len(todo) - failed, failed),
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+class Inotify(object):
+    'report files written or moved into some directories, using inotify'
+    mask = 0x08 | 0x80        # IN_CLOSE_WRITE | IN_MOVED_TO
+    event = struct.Struct('iIII')  # wd, mask, cookie, len (of name)
+
+    def __init__(self, dirs):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}        # watch descriptor -> directory
+        for path in dirs:
+            wd = libc.inotify_add_watch(
+                self.fd, path.encode(sys.getfilesystemencoding()), self.mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'cannot watch %s' % path)
+            self.dirs[wd] = path
+
+    def changes(self, timeout=None):
+        'return paths of files changed, waiting at most timeout seconds'
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        buf, pos, found = os.read(self.fd, 64 * 1024), 0, set()
+        while pos < len(buf):
+            wd, mask, cookie, size = self.event.unpack_from(buf, pos)
+            pos += self.event.size
+            name = buf[pos:pos + size].rstrip(b'\0')
+            pos += size
+            if wd in self.dirs:
+                found.add(os.path.join(self.dirs[wd], name.decode(
+                    sys.getfilesystemencoding())))
+        return found
+
+
+class Poller(object):
+    'report changed files by polling their mtimes, where inotify is missing'
+    interval = 0.5
+
+    def __init__(self, paths):
+        self.mtimes = dict((path, self.mtime(path)) for path in paths)
+
+    @staticmethod
+    def mtime(path):
+        'return mtime of path or None'
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def changes(self, timeout=None):
+        'return paths of files changed, waiting at most timeout seconds'
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            found = set()
+            for path, mtime in self.mtimes.items():
+                if self.mtime(path) != mtime:
+                    self.mtimes[path] = self.mtime(path)
+                    found.add(path)
+            if found or (deadline is not None and time() >= deadline):
+                return found
+            sleep(self.interval if deadline is None else
+                  max(0, min(self.interval, deadline - time())))
+
+
+def cmd_watch(argv):
+    'render changed codeblocks of documents as they are saved'
+    ap = argparse.ArgumentParser(
+        prog='pandoc-imagine watch',
+        description='watch documents and render codeblocks as they change, '
+                    'reporting events as json lines on stdout')
+    ap.add_argument('files', nargs='+',
+                    help='markdown (or other pandoc input) or json documents')
+    ap.add_argument('-f', '--from', dest='reader', default=None,
+                    help="pandoc's input format, if it cannot guess")
+    ap.add_argument('-t', '--to', dest='fmt', default='',
+                    help='output format the documents are intended for')
+    ap.add_argument('-j', '--jobs', type=int, default=scheduler.cpus,
+                    help='max number of renders to run in parallel')
+    ap.add_argument('-l', '--log', type=int, default=Handler.im_log,
+                    help='default im_log level')
+    ap.add_argument('-d', '--draft', action='store_true',
+                    help='default to im_draft=1')
+    args = ap.parse_args(argv)
+    Handler.im_log = args.log
+    Handler.im_draft = args.draft or Handler.im_draft
+    scheduler.cpus = max(1, args.jobs)
+
+    # renders run on a pool of threads that, like the fork servers of warm
+    # workers, lives as long as the watch, so a save only costs the renders
+    # of codeblocks not seen before.
+    paths = dict((os.path.abspath(f), f) for f in expand(args.files))
+    try:
+        watcher = Inotify(sorted(set(os.path.dirname(p) for p in paths)))
+    except (AttributeError, ImportError, OSError):
+        watcher = Poller(paths)
+    pool = ThreadPoolExecutor(max_workers=4 * scheduler.cpus + 16)
+    lock = threading.Lock()
+    outputs = {}              # fname -> {outfile: worker}
+    pending = set()           # outfiles being rendered
+
+    def emit(event, worker=None, **kwargs):
+        'print an event as a json line'
+        kwargs.update(event=event, at=round(time(), 3))
+        if worker is not None:
+            kwargs.update(doc=worker.doc, klass=worker.klass, key=worker.key,
+                          output=worker.outfile)
+        with lock:
+            print(json.dumps(kwargs, sort_keys=True))
+            sys.stdout.flush()
+
+    def render(worker):
+        'render a codeblock, report the outcome'
+        started = time()
+        try:
+            ok = worker.image() is not None
+        except Exception as e:
+            worker.msg(0, 'fail:', repr(e))
+            ok = False
+        seconds = round(time() - started, 3)
+        if ok:
+            emit('rendered', worker, seconds=seconds)
+        else:
+            emit('failed', worker, seconds=seconds,
+                 stderr=to_str(worker.stderr, 'utf-8')[-2048:])
+        with lock:
+            pending.discard(worker.outfile)
+
+    def update(fname):
+        'diff the codeblocks of a document with those seen before'
+        workers = workers4doc(fname, args.fmt, args.reader)
+        if workers is None:
+            return emit('error', doc=fname)
+        old = outputs.get(fname, {})
+        new = outputs[fname] = dict((w.outfile, w) for w in workers)
+        for outfile in sorted(set(old) - set(new)):
+            emit('removed', old[outfile])
+        for outfile, worker in sorted(new.items()):
+            if outfile in old:
+                continue
+            cached = worker.exists(outfile)
+            emit('changed', worker, cached=cached)
+            with lock:
+                if cached or outfile in pending:
+                    continue
+                pending.add(outfile)
+            pool.submit(render, worker)
+
+    for fname in sorted(paths.values()):
+        update(fname)
+    emit('ready', docs=len(paths), watcher=watcher.__class__.__name__.lower())
+    try:
+        while True:
+            changed = watcher.changes()
+            changed.update(watcher.changes(0.05))  # editors write in bursts
+            for path in sorted(changed):
+                if path in paths:
+                    update(paths[path])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown(wait=False)
+    return 0
+
+
+def cmd_stats(argv):
+    'report on rendering costs recorded in a ledger'
+    ap = argparse.ArgumentParser(
+        prog='pandoc-imagine stats',
+        description='report on renders and cache hits recorded in a ledger')
+    ap.add_argument('ledger', nargs='?', default=Handler.im_ledger,
+                    help='sqlite ledger, defaults to $IMAGINE_LEDGER')
+    ap.add_argument('-n', '--top', type=int, default=10,
+                    help='number of slowest codeblocks to list')
+    args = ap.parse_args(argv)
+    if not args.ledger or not os.path.isfile(args.ledger):
+        print('Imagine: no ledger found: %r' % args.ledger, file=sys.stderr)
+        return 1
+    ledger = Ledger.get(args.ledger)
+    if ledger.db is None:
+        return 1
+
+    def table(title, header, rows, fmt):
+        'print rows as a simple table'
+        print('\n%s\n' % title)
+        print(header)
+        print('-' * len(header))
+        for row in rows:
+            print(fmt % tuple('-' if x is None else x for x in row))
+
+    table('Slowest codeblocks',
+          '%8s %8s %8s %7s %5s  %-10s %-12s %s' % (
+              'avg(s)', 'max(s)', 'cpu(s)', 'rss(MB)', 'runs', 'klass', 'key',
+              'docs'),
+          ledger.query('''select avg(wall), max(wall), ifnull(avg(cpu), 0),
+                                 ifnull(max(rss), 0) / 1048576.0, count(*),
+                                 klass, substr(key, 1, 12),
+                                 group_concat(distinct doc)
+                          from renders where hit = 0
+                          group by key order by avg(wall) desc limit ?''',
+                       args.top),
+          '%8.2f %8.2f %8.2f %7.1f %5d  %-10s %-12s %s')
+
+    for what in ('doc', 'tool'):
+        table('Cache hit rate per %s' % what,
+              '%6s %6s %6s %6s  %s' % ('hits', 'runs', 'fails', 'rate',
+                                       what),
+              ledger.query('''select sum(hit), sum(1 - hit), sum(1 - ok),
+                                     100.0 * sum(hit) / count(*), %s
+                              from renders group by %s order by %s'''
+                           % (what, what, what)),
+              '%6d %6d %6d %5.1f%%  %s')
+
+    table('Disk used per klass',
+          '%8s %10s  %s' % ('entries', 'KB', 'klass'),
+          ledger.query('''select count(*), sum(size) / 1024.0, klass from
+                            (select klass, insize + outsize as size, max(at)
+                             from renders group by key)
+                          group by klass order by 2 desc'''),
+          '%8d %10.1f  %s')
+    return 0
+
+
+def packable():
+    'return extensions of files that belong in a pack'
+    # inputs are named after their klass, text outputs after their im_fmt
+    exts = set(Handler.workers)
+    exts.update(w.im_fmt for w in Handler.workers.values() if w.textual)
+    return exts
+
+
+def migrate(im_dir, layout):
+    'move all cache files in {im_dir}-images to another layout'
+    store = Store.get(im_dir, layout)
+    packable_exts = packable()
+    moved = 0
+
+    for path in store.files():
+        key, ext = os.path.basename(path).split('.', 1)
+        if store.pack and ext in packable_exts:
+            with open(path, 'rb') as f:
+                store.pack.put(os.path.basename(path), f.read())
+            os.remove(path)
+            moved += 1
+            continue
+        dst = '%s.%s' % (store.basename(key), ext)
+        if dst != path:
+            os.replace(path, dst)
+            moved += 1
+
+    pack = Pack(os.path.join(store.root, 'pack'))
+    if store.pack is None and os.path.isfile(pack.idxfile):
+        for name in pack.names():
+            key, ext = name.split('.', 1)
+            with open('%s.%s' % (store.basename(key), ext), 'wb') as f:
+                f.write(pack.get(name))
+            moved += 1
+        os.remove(pack.idxfile)
+        os.remove(pack.datfile)
+
+    # remove any shards left empty
+    for dirpath, dirnames, fnames in os.walk(store.root, topdown=False):
+        if dirpath != store.root and len(os.path.basename(dirpath)) == 2:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # not empty
+    print('Imagine: moved %d files into %s layout of %s' % (
+        moved, layout, store.root), file=sys.stderr)
+    return 0
+
+
+def serve(root, bind, port):
+    'serve a directory as a remote cache over http'
+    # a plain stand-in for a real cache server, handy for tests and small
+    # setups: GET, HEAD and PUT of <key>.<ext> files, nothing else.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    class Cache(BaseHTTPRequestHandler):
+        'handle requests for cache files'
+        protocol_version = 'HTTP/1.1'  # keep connections alive
+
+        def path4name(self):
+            'return local path for requested name or None if not acceptable'
+            name = self.path.rsplit('/', 1)[-1]
+            return os.path.join(root, name) if Store.keyname(name) else None
+
+        def reply(self, status, data=b''):
+            'send a response'
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path4name()
+            if path is None or not os.path.isfile(path):
+                return self.reply(404)
+            with open(path, 'rb') as f:
+                self.reply(200, f.read())
+
+        do_HEAD = do_GET
+
+        def do_PUT(self):
+            path = self.path4name()
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if path is None:
+                return self.reply(400)
+            tmpfile = '%s.%s.tmp' % (path, threading.current_thread().ident)
+            with open(tmpfile, 'wb') as f:
+                f.write(data)
+            os.replace(tmpfile, path)
+            self.reply(201)
+
+        def log_message(self, fmt, *args):
+            print('Imagine: %s' % (fmt % args), file=sys.stderr)
+
+    server = ThreadingHTTPServer((bind, port), Cache)
+    print('Imagine: serving %s on http://%s:%d/' % (
+        root, bind, server.server_address[1]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def programs():
+    'return the programs workers may run, i.e. those of their cmdmaps'
+    return set(prg for w in Handler.workers.values() if w is not Imagine
+               for prg in list(w.cmdmap.values()) + w.helpers) - \
+        set(['shebang'])
+
+
+def run_job(job, shebang=False):
+    'run a job sent by Agents.run in a scratch dir, return the reply'
+    # only runs the programs of workers or, if shebang, a job's own script
+    argv = job['argv']
+    if not argv or not (argv[0] in programs() or shebang and (
+            argv[0] in job['files'] and argv[0].endswith('.shebang'))):
+        return {'error': 'refused program %r' % (argv or [''])[0]}
+    scratch = tempfile.mkdtemp(prefix='imagine-agent-')
+    try:
+        for name in list(job['files']) + job['outputs']:
+            if os.path.isabs(name) or '..' in name.split('/'):
+                return {'error': 'refused file name %r' % name}
+            if not os.path.isdir(os.path.join(scratch, os.path.dirname(name))):
+                os.makedirs(os.path.join(scratch, os.path.dirname(name)))
+        for name, data in job['files'].items():
+            with open(os.path.join(scratch, name), 'wb') as f:
+                f.write(base64.b64decode(data))
+        if argv[0] in job['files']:
+            path = os.path.join(scratch, argv[0])
+            os.chmod(path, stat.S_IEXEC | os.stat(path).st_mode)
+            argv = [os.path.join('.', argv[0])] + argv[1:]
+        stdin = job['stdin']
+        if stdin is not None:
+            stdin = to_str(base64.b64decode(stdin), 'utf-8')
+        with scheduler.slot(job.get('klass'), job.get('im_jobs', 0),
+                            job.get('im_mem', 0) * 1024 * 1024,
+                            job.get('expected')):
+            try:
+                returncode, out, err, usage = spawn(
+                    argv, stdin, timeout=job.get('timeout'),
+                    limits=job.get('limits'), cwd=scratch,
+                    env=dict(os.environ, **job.get('env', {})))
+            except OSError as e:
+                # e.g. the tool is not installed here, which says nothing
+                # about the job itself: the host may run it elsewhere
+                return {'returncode': 127, 'stdout': '',
+                        'stderr': to_str(base64.b64encode(to_bytes(
+                            str(e), 'utf-8'))),
+                        'files': {}, 'usage': {}, 'missing': True}
+
+        files = {}
+        for dirpath, dirnames, fnames in os.walk(scratch):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                name = os.path.relpath(path, scratch)
+                if name not in job['files']:
+                    with open(path, 'rb') as f:
+                        files[name] = to_str(base64.b64encode(f.read()))
+        return {'returncode': returncode,
+                'stdout': to_str(base64.b64encode(out)),
+                'stderr': to_str(base64.b64encode(err)),
+                'files': files, 'usage': usage}
+    except (OSError, IOError) as e:
+        return {'error': str(e)}
+    finally:
+        shutil.rmtree(scratch, True)
+
+
+def cmd_agent(argv):
+    'run render jobs for other hosts'
+    ap = argparse.ArgumentParser(
+        prog='pandoc-imagine agent',
+        description='run render jobs sent by hosts using im_agents')
+    ap.add_argument('-b', '--bind', default='127.0.0.1',
+                    help='address to listen on')
+    ap.add_argument('-p', '--port', type=int, default=8009,
+                    help='port to listen on')
+    ap.add_argument('-j', '--jobs', type=int, default=scheduler.cpus,
+                    help='max number of jobs to run in parallel')
+    ap.add_argument('-t', '--token', default=os.environ.get(
+                    'IMAGINE_AGENT_TOKEN'),
+                    help='bearer token required from clients, defaults to '
+                         '$IMAGINE_AGENT_TOKEN')
+    ap.add_argument('-s', '--shebang', action='store_true',
+                    help='also run shebang codeblocks, i.e. any script sent')
+    args = ap.parse_args(argv)
+    if not (args.token or loopback(args.bind)):
+        print('Imagine: refusing to listen on %s without a token' % args.bind,
+              file=sys.stderr)
+        return 1
+    scheduler.cpus = max(1, args.jobs)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Agent(BaseHTTPRequestHandler):
+        'handle POST /run requests'
+        protocol_version = 'HTTP/1.1'  # keep connections alive
+
+        def reply(self, status, data=b''):
+            'send a response'
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if args.token and self.headers.get('Authorization') != \
+                    'Bearer %s' % args.token:
+                return self.reply(401)
+            if self.path.rstrip('/').rsplit('/', 1)[-1] != 'run':
+                return self.reply(404)
+            # a browser cannot post json to another site without asking
+            ctype = self.headers.get('Content-Type', '').split(';')[0]
+            if ctype.strip().lower() != 'application/json':
+                return self.reply(415)
+            try:
+                job = json.loads(to_str(body, 'utf-8'))
+                if not isinstance(job.get('argv'), list):
+                    raise ValueError('no argv')
+            except (ValueError, AttributeError):
+                return self.reply(400)
+            self.reply(200, to_bytes(json.dumps(run_job(job, args.shebang))))
+
+        def log_message(self, fmt, *a):
+            print('Imagine: %s' % (fmt % a), file=sys.stderr)
+
+    server = ThreadingHTTPServer((args.bind, args.port), Agent)
+    print('Imagine: agent listening on http://%s:%d/, %d jobs' % (
+        args.bind, server.server_address[1], scheduler.cpus),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+class RenderService(object):
+    'render codeblocks on request, sharing identical renders in progress'
+    # Server policy (im_dir, limits, timeouts) is set through meta, so it
+    # need not show up in the codeblocks and thus in their cache keys.
+    policy = set(['im_dir', 'im_layout', 'im_jobs', 'im_mem', 'im_timeout',
+                  'im_prg', 'im_tmpdir', 'im_ledger', 'im_agents',
+                  'im_budget', 'im_cache', 'im_cache_mode', 'im_scratch',
+                  'im_preload', 'im_max_output'])
+    window = 1000             # latencies kept, per klass, for percentiles
+
+    def __init__(self, meta=None):
+        self.meta = dict((k, {'t': 'MetaInlines', 'c': [{'t': 'Str',
+                                                         'c': str(v)}]})
+                         for k, v in (meta or {}).items())
+        self.lock = threading.Lock()
+        self.started = time()
+        self.stats = {}       # klass -> counters and recent latencies
+
+    def render(self, klass, code, attrs):
+        'return (RenderResult, how) with how one of hit, miss or shared'
+        started = time()
+        result, shared = render_shared(klass, code, meta=self.meta, **attrs)
+        how = 'shared' if shared else 'hit' if result.cached else 'miss'
+        self.record(klass, how, result.ok, time() - started)
+        return result, how
+
+    def record(self, klass, how, ok, seconds):
+        'count a request and its latency'
+        with self.lock:
+            stats = self.stats.setdefault(klass, {
+                'requests': 0, 'hit': 0, 'miss': 0, 'shared': 0, 'failed': 0,
+                'seconds': 0.0, 'latencies': deque(maxlen=self.window)})
+            stats['requests'] += 1
+            stats[how] += 1
+            stats['failed'] += 0 if ok else 1
+            stats['seconds'] += seconds
+            stats['latencies'].append(seconds)
+
+    def metrics(self):
+        'return request counts, hit rates and latencies, overall & per klass'
+        def summary(stats):
+            'return stats as reported'
+            lat = sorted(stats['latencies'])
+            rv = dict((k, v) for k, v in stats.items() if k != 'latencies')
+            rv['seconds'] = round(rv['seconds'], 3)
+            rv['hit_rate'] = round(float(stats['hit'] + stats['shared']) /
+                                   max(1, stats['requests']), 3)
+            for name, pct in (('p50', 0.5), ('p95', 0.95), ('max', 1.0)):
+                rv[name] = round(lat[int(pct * (len(lat) - 1))], 3) \
+                    if lat else None
+            return rv
+
+        with self.lock:
+            total = {'requests': 0, 'hit': 0, 'miss': 0, 'shared': 0,
+                     'failed': 0, 'seconds': 0.0, 'latencies': []}
+            for stats in self.stats.values():
+                for k, v in stats.items():
+                    total[k] += list(v) if k == 'latencies' else v
+            return {'uptime': round(time() - self.started, 3),
+                    'inflight': len(inflight),
+                    'total': summary(total),
+                    'klass': dict((k, summary(v))
+                                  for k, v in sorted(self.stats.items()))}
+
+
+def cmd_serve(argv):
+    'render codeblocks on request over http'
+    ap = argparse.ArgumentParser(
+        prog='pandoc-imagine serve',
+        description='render codeblocks posted to /render/<klass>?fmt=svg')
+    ap.add_argument('--http', default='127.0.0.1:8010', metavar='ADDR',
+                    help='[address:]port to listen on, default %(default)s')
+    ap.add_argument('-d', '--dir', default=Handler.im_dir,
+                    help='im_dir to cache renders in, default %(default)s')
+    ap.add_argument('-j', '--jobs', type=int, default=scheduler.cpus,
+                    help='max number of renders to run in parallel')
+    ap.add_argument('-l', '--limit', action='append', default=[],
+                    metavar='KLASS=N',
+                    help='max parallel renders of a klass (im_jobs)')
+    ap.add_argument('-t', '--timeout', action='append', default=[],
+                    metavar='[KLASS=]SECONDS',
+                    help='kill renders taking longer (im_timeout), '
+                         'default 60')
+    ap.add_argument('-a', '--allow', action='append', default=[],
+                    metavar='KLASS',
+                    help='klass to render (may be repeated), default all but '
+                         'shebang')
+    ap.add_argument('--token', default=os.environ.get('IMAGINE_SERVE_TOKEN'),
+                    help='bearer token required from clients, defaults to '
+                         '$IMAGINE_SERVE_TOKEN')
+    args = ap.parse_args(argv)
+    scheduler.cpus = max(1, args.jobs)
+    bind, _, port = args.http.rpartition(':')
+    bind = bind or '127.0.0.1'
+    if not (args.token or loopback(bind)):
+        print('Imagine: refusing to listen on %s without a token' % bind,
+              file=sys.stderr)
+        return 1
+    allowed = set(k.lower() for k in args.allow) or \
+        set(Handler.workers) - set(['shebang'])
+    allowed.discard('imagine')
+    unknown = allowed - set(Handler.workers)
+    if unknown:
+        print('Imagine: no worker for %s' % ', '.join(sorted(unknown)),
+              file=sys.stderr)
+        return 1
+    import mimetypes
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    meta = {'imagine.im_dir': args.dir, 'imagine.im_timeout': 60}
+    for opt, vals in (('im_jobs', args.limit), ('im_timeout', args.timeout)):
+        for val in vals:
+            klass, _, val = val.rpartition('=')
+            key = 'imagine.%s.%s' % (klass, opt) if klass else \
+                'imagine.%s' % opt
+            meta[key] = val
+    service = RenderService(meta)
+
+    class Server(BaseHTTPRequestHandler):
+        'handle POST /render/<klass> and GET /metrics requests'
+        protocol_version = 'HTTP/1.1'  # keep connections alive
+
+        def reply(self, status, data=b'', ctype='text/plain; charset=utf-8',
+                  headers=()):
+            'send a response'
+            data = to_bytes(data, 'utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            for hdr, val in headers:
+                self.send_header(hdr, val)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(data)
+
+        def authorized(self):
+            'say whether the request carries the token, if one is required'
+            return not args.token or self.headers.get('Authorization') == \
+                'Bearer %s' % args.token
+
+        def do_GET(self):
+            if not self.authorized():
+                return self.reply(401)
+            path = urlsplit(self.path).path.rstrip('/')
+            if path == '/metrics':
+                return self.reply(200, json.dumps(service.metrics(),
+                                                  sort_keys=True),
+                                  'application/json')
+            if path == '/render':
+                return self.reply(200, json.dumps(sorted(allowed)),
+                                  'application/json')
+            self.reply(404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self.authorized():
+                return self.reply(401)
+            url = urlsplit(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'render':
+                return self.reply(404)
+            klass = parts[1].lower()
+            if klass not in allowed:
+                return self.reply(404, 'no worker for klass %r\n' % klass)
+            attrs = {}
+            for key, val in parse_qsl(url.query):
+                key = 'im_fmt' if key == 'fmt' else key
+                if key in service.policy:
+                    return self.reply(400, '%s is set by the server\n' % key)
+                if not key.startswith('im_') or not hasattr(Handler, key):
+                    return self.reply(400, 'unknown option %r\n' % key)
+                attrs[key] = val
+            try:
+                code = to_str(body, 'utf-8')
+                result, how = service.render(klass, code, attrs)
+            except ValueError as e:
+                return self.reply(400, '%s\n' % e)
+            except Exception as e:
+                return self.reply(500, '%s\n' % e)
+
+            headers = [('X-Imagine-Key', result.key),
+                       ('X-Imagine-Cache', how)]
+            if not result.ok:
+                return self.reply(422, result.stderr or 'render failed\n',
+                                  headers=headers)
+            headers.append(('ETag', '"%s"' % result.key))
+            if result.data is None:
+                return self.reply(200, result.stdout, headers=headers)
+            ctype = mimetypes.guess_type(result.path)[0]
+            if Handler.workers[klass].textual or ctype is None and \
+                    result.path.endswith('.txt'):
+                ctype = 'text/plain; charset=utf-8'
+            self.reply(200, result.data, ctype or 'application/octet-stream',
+                       headers=headers)
+
+        def log_message(self, fmt, *a):
+            print('Imagine: %s' % (fmt % a), file=sys.stderr)
+
+    server = ThreadingHTTPServer((bind, int(port)), Server)
+    server.daemon_threads = True
+    print('Imagine: serving renders on http://%s:%d/render/<klass>, %d jobs' %
+          (bind, server.server_address[1], scheduler.cpus), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def entries(store):
+    'return {key: {name: function returning data}} of a cache, any layout'
+    found = {}
+
+    def reader(path):
+        'return function that reads a file'
+        def read():
+            with open(path, 'rb') as f:
+                return f.read()
+        return read
+
+    for path in store.files():
+        name = os.path.basename(path)
+        found.setdefault(name.split('.', 1)[0], {})[name] = reader(path)
+    pack = Pack(os.path.join(store.root, 'pack'))
+    for name in pack.names():
+        found.setdefault(name.split('.', 1)[0], {})[name] = (
+            lambda name=name: pack.get(name))
+    return found
+
+
+def export(im_dir, bundle, keys=None):
+    'write cache entries, all or just those for keys, into a zip bundle'
+    # index.json lists the files of each entry with their sha256, which
+    # import checks before adding any of them to a cache.
+    import zipfile
+    found = entries(Store.get(im_dir))
+    keys = sorted(found) if keys is None else sorted(set(keys) & set(found))
+    index = {'version': 1, 'entries': {}}
+    tmpfile = bundle + '.tmp'
+    with zipfile.ZipFile(tmpfile, 'w', zipfile.ZIP_DEFLATED) as z:
+        for key in keys:
+            files = index['entries'][key] = {}
+            for name, read in sorted(found[key].items()):
+                data = read()
+                if data is None:
+                    continue
+                files[name] = hashlib.sha256(data).hexdigest()
+                z.writestr(name, data)
+        z.writestr('index.json', json.dumps(index, sort_keys=True, indent=1))
+    os.replace(tmpfile, bundle)
+    print('Imagine: exported %d entries into %s' % (len(keys), bundle),
+          file=sys.stderr)
+    return 0
+
+
+def detect_layout(root):
+    'return the layout a cache seems to use'
+    if os.path.isfile(os.path.join(root, 'pack.idx')):
+        return 'pack'
+    if os.path.isdir(root) and any(len(d) == 2 and os.path.isdir(
+            os.path.join(root, d)) for d in os.listdir(root)):
+        return 'sharded'
+    return 'flat'
+
+
+def import_(im_dir, bundle, layout=None):
+    'merge the entries of a bundle into a cache, skipping those present'
+    import zipfile
+    root = Store.get(im_dir).root
+    store = Store.get(im_dir, layout or detect_layout(root))
+    exts = packable() if store.pack else set()
+    added = skipped = bad = 0
+    try:
+        z = zipfile.ZipFile(bundle)
+        index = json.loads(to_str(z.read('index.json'), 'utf-8'))
+    except (OSError, IOError, KeyError, ValueError, zipfile.BadZipfile) as e:
+        print('Imagine: cannot read bundle %s (%s)' % (bundle, e),
+              file=sys.stderr)
+        return 1
+    with z:
+        for key, files in sorted(index['entries'].items()):
+            # check all files of an entry first, so it's added whole or not
+            datas = {}
+            for name, digest in files.items():
+                try:
+                    data = z.read(name)
+                except (KeyError, zipfile.BadZipfile):
+                    data = None
+                if not Store.keyname(name) or \
+                        name.partition('.')[0] != key or data is None or \
+                        hashlib.sha256(data).hexdigest() != digest:
+                    print('Imagine: bad entry %s in %s (%s)' % (
+                        key, bundle, name), file=sys.stderr)
+                    datas = None
+                    break
+                datas[name] = data
+            if datas is None:
+                bad += 1
+                continue
+            try:
+                for name, data in sorted(datas.items()):
+                    ext = name.split('.', 1)[1]
+                    if ext in exts:
+                        if store.pack.entry(name) is None:
+                            store.pack.put(name, data)
+                            added += 1
+                        else:
+                            skipped += 1
+                        continue
+                    path = '%s.%s' % (store.basename(key), ext)
+                    if os.path.isfile(path):
+                        skipped += 1
+                        continue
+                    with open(path + '.tmp', 'wb') as f:
+                        f.write(data)
+                    os.replace(path + '.tmp', path)
+                    added += 1
+            except (OSError, IOError) as e:
+                print('Imagine: cannot import entry %s from %s (%s)' % (
+                    key, bundle, e), file=sys.stderr)
+                bad += 1
+    print('Imagine: imported %d files from %s into %s, %d present, %d bad '
+          'entries' % (added, bundle, store.root, skipped, bad),
+          file=sys.stderr)
+    return 1 if bad else 0
+
+
+def cmd_cache(argv):
+    'maintain the cache directory'
+    ap = argparse.ArgumentParser(prog='pandoc-imagine cache',
+                                 description='maintain {im_dir}-images')
+    sub = ap.add_subparsers(dest='action')
+    sub.required = True
+
+    mig = sub.add_parser('migrate', help='move files to another layout')
+    mig.add_argument('layout', choices=Store.layouts,
+                     help='layout to migrate to')
+    mig.add_argument('-d', '--dir', default=Handler.im_dir,
+                     help='im_dir of the cache (without -images)')
+
+    srv = sub.add_parser('serve', help='serve a directory as remote cache')
+    srv.add_argument('root', help='directory holding the cache files')
+    srv.add_argument('-b', '--bind', default='127.0.0.1',
+                     help='address to listen on')
+    srv.add_argument('-p', '--port', type=int, default=8008,
+                     help='port to listen on')
+
+    exp = sub.add_parser('export', help='write cache entries into a bundle')
+    exp.add_argument('bundle', help='zip file to write')
+    exp.add_argument('docs', nargs='*',
+                     help='only export entries for these documents')
+    exp.add_argument('-k', '--key', action='append', dest='keys',
+                     help='only export this key (may be repeated)')
+    exp.add_argument('-f', '--from', dest='reader', default=None,
+                     help="pandoc's input format, if it cannot guess")
+    exp.add_argument('-d', '--dir', default=Handler.im_dir,
+                     help='im_dir of the cache (without -images)')
+
+    imp = sub.add_parser('import', help='merge a bundle into the cache')
+    imp.add_argument('bundle', help='zip file written by export')
+    imp.add_argument('-l', '--layout', choices=Store.layouts, default=None,
+                     help="layout to use, defaults to the cache's current one")
+    imp.add_argument('-d', '--dir', default=Handler.im_dir,
+                     help='im_dir of the cache (without -images)')
+
+    args = ap.parse_args(argv)
+    if args.action == 'migrate':
+        return migrate(args.dir, args.layout)
+    if args.action == 'export':
+        keys = args.keys
+        if args.docs:
+            keys = (keys or []) + sorted(keys4docs(expand(args.docs),
+                                                   args.reader))
+        return export(args.dir, args.bundle, keys)
+    if args.action == 'import':
+        return import_(args.dir, args.bundle, args.layout)
+    if args.action == 'serve':
+        return serve(args.root, args.bind, args.port)
+    return 1
+
+
+commands = {'render': cmd_render, 'stats': cmd_stats, 'cache': cmd_cache,
+            'agent': cmd_agent, 'watch': cmd_watch, 'serve': cmd_serve}
+
+
+#-- profiling
+class Profiler(object):
+    'profile imagine itself while running main, see IMAGINE_PROFILE'
+    # Either cProfile (pstats output) or sampling all threads every interval
+    # seconds (collapsed stacks output, for flamegraph.pl or speedscope).
+    # Phases count the calls and (outermost, inclusive) seconds spent in the
+    # filter's hot spots, tools run by cmd included.
+    active = False
+    interval = 0.001
+    hotspots = {Handler: ['__call__', 'get_cb_opts', 'get_md_opts', 'cmd',
+                          'result', 'anon_codeblock']}
+
+    def __init__(self, path):
+        self.path = path
+        self.phases = {}      # phase -> [calls, seconds]
+        self.stacks = {}      # collapsed stack -> number of samples
+        self.done = threading.Event()
+        self.local = threading.local()
+        self.wrapper = None   # code of the wrappers made by timed
+        self.docs = set()     # documents seen by dispatching handlers
+
+    def timed(self, phase, func):
+        'return func, counting its calls and time as phase'
+        counter = self.phases.setdefault(phase, [0, 0.0])
+        local = self.local
+
+        def wrapper(*args, **kwargs):
+            'call func, time only the outermost (e.g. walk is recursive)'
+            depth = getattr(local, phase, 0)
+            counter[0] += 1
+            if depth:
+                return func(*args, **kwargs)
+            setattr(local, phase, 1)
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counter[1] += perf_counter() - started
+                setattr(local, phase, 0)
+        self.wrapper = wrapper.__code__  # left out of sampled stacks
+        return wrapper
+
+    def instrument(self):
+        'wrap the hot spots, so they count as phases'
+        module = sys.modules[__name__]
+        dispatch = Handler.__call__
+
+        def call(handler, *args, **kwargs):
+            'dispatch a codeblock, noting the document it came from'
+            self.docs.add(handler.doc or '-')
+            return dispatch(handler, *args, **kwargs)
+        Handler.__call__ = call
+        for name in ('to_str', 'to_bytes', 'prefetch'):
+            setattr(module, name, self.timed(name, getattr(module, name)))
+        for cls, names in self.hotspots.items():
+            for name in names:
+                setattr(cls, name, self.timed(name, getattr(cls, name)))
+        for cls in set(Handler.workers.values()):
+            if 'image' in cls.__dict__:
+                cls.image = self.timed('image', cls.image)
+        Store.key = staticmethod(self.timed('key', Store.key))
+        pf.walk = self.timed('walk', pf.walk)
+
+    def sample(self):
+        'sample the stacks of all other threads until done'
+        me = threading.current_thread().ident
+        while not self.done.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code is not self.wrapper:
+                        stack.append('%s (%s:%d)' % (
+                            code.co_name, os.path.basename(code.co_filename),
+                            code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def run(self, func):
+        'run func under the profiler, then save and report the results'
+        Profiler.active = True
+        self.instrument()
+        sampler = profile = None
+        if self.path.endswith('.folded'):
+            sampler = threading.Thread(target=self.sample, daemon=True)
+            sampler.start()
+        else:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        started = perf_counter()
+        try:
+            return func()
+        finally:
+            elapsed = perf_counter() - started
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.path)
+            else:
+                self.done.set()
+                sampler.join()
+                with open(self.path, 'w') as f:
+                    for stack, count in sorted(self.stacks.items()):
+                        f.write('%s %d\n' % (stack, count))
+            self.report(elapsed)
+
+    def report(self, elapsed):
+        'print the phases on stderr'
+        out = sys.stderr
+        docs = sorted(self.docs) or ['-']
+        if len(docs) > 3:
+            docs = ['%d documents' % len(docs)]
+        print('Imagine: profile of %s (%s) written to %s' % (
+            ', '.join(docs), ' '.join(sys.argv[1:]) or 'filter',
+            self.path), file=out)
+        # commands render on many threads, whose seconds add up to more
+        # than the time elapsed, so only a filter run gets percentages
+        threaded = len(sys.argv) > 1 and sys.argv[1] in commands
+        print('  %-16s %8s %10s %6s' % (
+            'phase', 'calls', 'thread-sec' if threaded else 'seconds',
+            '' if threaded else '%'), file=out)
+        for phase, (calls, seconds) in sorted(self.phases.items(),
+                                              key=lambda x: -x[1][1]):
+            if calls:
+                print('  %-16s %8d %10.4f %6s' % (
+                    phase, calls, seconds, '' if threaded else '%.1f' % (
+                        100 * seconds / max(elapsed, 1e-9))), file=out)
+        print('  %-16s %8s %10.4f %6s' % (
+            'total (elapsed)' if threaded else 'total', '', elapsed,
+            '' if threaded else '100.0'), file=out)
+        if not threaded:
+            # as a filter, cmd runs within the walk
+            own = self.phases['walk'][1] - self.phases['cmd'][1]
+            print('  %-16s %8s %10.4f %6s' % ('walk - cmd', '', own, ''),
+                  file=out)
+
+
 # for PyPI
 def main():
     'main entry point'
+    path = os.environ.get('IMAGINE_PROFILE')
+    if path and not Profiler.active:
+        return Profiler(path).run(main)
+
     def walker(key, value, fmt, meta):
         'walk down the pandoc AST and invoke workers for CodeBlocks'
 
         if key == 'CodeBlock':
-            return dispatch(value, fmt, meta).image()
+            if dispatch.doc is None:
+                # a filter never sees the input file name, use its title
+                title = meta.get('title')
+                dispatch.doc = pf.stringify(title) if title else '-'
+            worker = dispatch(value, fmt, meta)
+            rv = worker.image()
+            if rv is None and getattr(worker, 'deferred', False):
+                return worker.placeholder()
+            return rv
+
+    # pandoc calls a filter with the output format as its first argument,
+    # which never clashes with one of Imagine's own commands
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        sys.exit(commands[sys.argv[1]](sys.argv[2:]))
 
     dispatch = Handler(None, None, None)
-    pf.toJSONFilter(walker)
+    # like pf.toJSONFilter, but with a chance to prefetch the outputs of all
+    # codeblocks from a remote cache before walking the document
+    source = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8').read()
+    fmt = sys.argv[1] if len(sys.argv) > 1 else ''
+    doc = json.loads(source)
+    blocks, meta = codeblocks(doc)
+    if Handler.im_cache or any('im_cache' in k for k in meta) or \
+            any(k == 'im_cache' for codec in blocks for k, v in codec[0][2]):
+        workers = []
+        for codec in blocks:
+            try:
+                worker = dispatch(codec, fmt, meta)
+            except Exception:
+                continue  # the walker will complain about it
+            if worker.__class__ not in (Handler, Imagine):
+                workers.append(worker)
+        prefetch(workers)
+    budget.enabled = True
+    sys.stdout.write(json.dumps(pf.walk(doc, walker, fmt, meta)))
+    sys.stdout.flush()
+    if isinstance(doc, dict):
+        budget.launch(meta, fmt, doc.get('pandoc-api-version'))
 
 if __name__ == '__main__':
     main()
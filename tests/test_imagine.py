@@ -0,0 +1,390 @@
+'''
+Tests for pandoc_imagine, run with `python -m pytest tests`
+'''
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import zipfile
+import time
+import zlib
+import http.client
+import socket
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pandoc_imagine as pi
+
+
+@pytest.fixture
+def im_dir(tmp_path, monkeypatch):
+    'run in a fresh working dir, return an (absolute) im_dir'
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'pd')
+
+
+def test_pack_put_same_data_does_not_grow(im_dir):
+    pack = pi.Pack(im_dir)
+    pack.put('a.txt', 'hello')
+    size = os.path.getsize(pack.datfile)
+    pack.put('a.txt', 'hello')
+    assert os.path.getsize(pack.datfile) == size
+    pack.put('a.txt', 'world')
+    assert pack.get('a.txt') == b'world'
+
+
+def test_pack_size_stays_the_same_on_rerun(im_dir):
+    # pyxplot rewrites its inpfile on every run, installed or not
+    sizes = []
+    for _ in range(3):
+        pi.render('pyxplot', 'plot sin(x)', im_dir=im_dir, im_layout='pack')
+        sizes.append(os.path.getsize(os.path.join(im_dir + '-images',
+                                                  'pack.dat')))
+    assert sizes[0] == sizes[1] == sizes[2]
+
+
+def test_broken_fork_server_is_not_restarted(im_dir, tmp_path, monkeypatch):
+    (tmp_path / 'deadmod.py').write_text('import os\nos._exit(1)\n')
+    (tmp_path / 'hi.py').write_text('print("hi")\n')
+    monkeypatch.setenv('PYTHONPATH', str(tmp_path))
+    started = []
+    server = pi.ForkServer
+    monkeypatch.setattr(pi, 'ForkServer',
+                        lambda *a: started.append(a) or server(*a))
+    servers = pi.ForkServers()
+    for _ in range(3):
+        assert servers.run(sys.executable, ['deadmod'], ['hi.py']) is None
+    assert len(started) == 1
+
+
+def test_codeblock_reads_sibling_data_file(im_dir, tmp_path):
+    (tmp_path / 'data.txt').write_text('some data\n')
+    code = '#!/bin/sh\ncat data.txt\n'
+    rv = pi.render('shebang', code, im_dir=im_dir, im_out='stdout')
+    assert rv.ok
+    assert rv.stdout == 'some data\n'
+
+
+def test_normalize_svg_renames_ids_not_text():
+    svg = ('<svg><defs><clipPath id="clip123456"/></defs>'
+           '<g clip-path="url(#clip123456)"><use xlink:href="#clip123456"/>'
+           '<use href="#clip123456"/><text>clip123456</text></g></svg>')
+    out = pi.normalize_svg(svg.encode('utf-8'), 'abcdef0123456789')
+    out = out.decode('utf-8')
+    new = 'imabcdef01-0'
+    assert 'id="%s"' % new in out
+    assert 'url(#%s)' % new in out
+    assert 'xlink:href="#%s"' % new in out
+    assert '<use href="#%s"/>' % new in out
+    assert '<text>clip123456</text>' in out
+
+
+def test_keyname_skips_leftovers():
+    key = 'a' * 40
+    assert pi.Store.keyname(key + '.png')
+    assert not pi.Store.keyname(key + '.png.1234.tmp')
+    assert not pi.Store.keyname(key + '.deferred')
+    assert not pi.Store.keyname('pack.dat')
+    assert not pi.Store.keyname(key + '.png/../../x')
+    assert not pi.Store.keyname('x/' + key + '.png')
+
+
+def test_im_retry_retries_the_same_entry(im_dir, tmp_path):
+    code = '#!/bin/sh\ncat data.txt\n'
+    first = pi.render('shebang', code, im_dir=im_dir, im_out='stdout')
+    assert not first.ok
+    (tmp_path / 'data.txt').write_text('now there\n')
+    assert not pi.render('shebang', code, im_dir=im_dir, im_out='stdout').ok
+    retry = pi.render('shebang', code, im_dir=im_dir, im_out='stdout',
+                      im_retry=1)
+    assert retry.ok and retry.key == first.key
+    assert pi.render('shebang', code, im_dir=im_dir, im_out='stdout').ok
+
+
+def free_port():
+    'return a port nobody listens on, for now'
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start(port, *args):
+    'start pandoc-imagine with args, return its process once port listens'
+    p = subprocess.Popen([sys.executable, pi.__file__] + list(args),
+                         stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return p
+        except OSError:
+            time.sleep(0.05)
+    p.kill()
+    pytest.fail('%s did not start' % args[0])
+
+
+def start_cache(root, port):
+    'start `cache serve` for root on port, return its process'
+    return start(port, 'cache', 'serve', str(root), '-p', str(port))
+
+
+@pytest.fixture
+def cache_url(tmp_path):
+    'serve tmp_path/srv as remote cache, return its url'
+    port = free_port()
+    p = start_cache(tmp_path / 'srv', port)
+    yield 'http://127.0.0.1:%d/' % port
+    p.kill()
+    p.wait()
+
+
+def test_http_remote_fetch_and_upload(cache_url, tmp_path):
+    remote = pi.HTTPRemote(cache_url)
+    name = 'b' * 40 + '.png'
+    assert remote.fetch(name) is None
+    assert remote.store(name, b'png data')
+    assert remote.fetch(name) == b'png data'
+    assert (tmp_path / 'srv' / name).read_bytes() == b'png data'
+    assert not remote.store('../escape.png', b'x')  # refused by the server
+
+
+def test_http_remote_survives_a_server_restart(tmp_path):
+    port = free_port()
+    url = 'http://127.0.0.1:%d/' % port
+    remote = pi.HTTPRemote(url)
+    name = 'c' * 40 + '.png'
+    p = start_cache(tmp_path / 'srv', port)
+    try:
+        assert remote.store(name, b'png data')
+        assert remote.http.idle  # kept alive
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.connect()
+        remote.http.idle.append(conn)  # more than one goes stale
+    finally:
+        p.kill()
+        p.wait()
+    p = start_cache(tmp_path / 'srv', port)
+    try:
+        assert remote.fetch(name) == b'png data'
+        assert not remote.down
+    finally:
+        p.kill()
+        p.wait()
+
+
+def test_http_remote_down_is_retried_later(monkeypatch):
+    remote = pi.HTTPRemote('http://127.0.0.1:%d/' % free_port())
+    name = 'd' * 40 + '.png'
+    assert not remote.store(name, b'x')
+    assert remote.down > time.time()
+    monkeypatch.setattr(remote, 'write', lambda name, data: None)
+    assert not remote.store(name, b'x')  # still paused
+    remote.down = 0
+    assert remote.store(name, b'x')
+
+
+def test_read_only_remote_gets_no_uploads(cache_url, im_dir, tmp_path):
+    code = '#!/bin/sh\necho hi > "$1"\n'
+    pi.render('shebang', code, im_dir=im_dir, im_cache=cache_url,
+              im_cache_mode='ro')
+    assert not os.listdir(str(tmp_path / 'srv'))
+
+
+def test_unreachable_agent_fails_over_to_local_run(im_dir, monkeypatch):
+    url = '127.0.0.1:%d' % free_port()
+    monkeypatch.setattr(pi, 'agents', pi.Agents())
+    rv = pi.render('shebang', '#!/bin/sh\necho local\n', im_dir=im_dir,
+                   im_out='stdout', im_agents=url)
+    assert rv.ok
+    assert rv.stdout == 'local\n'
+    assert pi.agents.down[url] > time.time()
+
+
+def png(width, height, *chunks):
+    'return a minimal grayscale png with some extra chunks before its data'
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', crc)
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    rows = b''.join(b'\0' + b'\xff' * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + \
+        b''.join(chunk(k, d) for k, d in chunks) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def test_normalize_png_drops_times_and_versions(tmp_path):
+    plain = png(3, 2)
+    noisy = png(3, 2, (b'tIME', b'\x07\xe4\x01\x02\x03\x04\x05'),
+                (b'tEXt', b'Software\0tool 1.2.3'),
+                (b'tEXt', b'Title\0a plot'))
+    out = pi.normalize_png(noisy)
+    assert b'tIME' not in out and b'Software' not in out
+    assert b'a plot' in out
+    assert pi.normalize_png(plain) == plain
+    (tmp_path / 'a.png').write_bytes(out)
+    assert pi.image_size(str(tmp_path / 'a.png')) == (3, 2)
+
+
+def test_normalize_pdf_keeps_offsets(tmp_path):
+    pdf = (b"%PDF-1.4\n1 0 obj << /Type /Page /MediaBox [0 0 72 36] >>\n"
+           b"2 0 obj << /CreationDate (D:20200102030405+01'00') >>\n"
+           b"trailer << /ID [<0123456789abcdef><0123456789abcdef>] >>\n"
+           b"%%EOF\n")
+    out = pi.normalize_pdf(pdf, 0, 'salt')
+    assert len(out) == len(pdf)
+    assert b"(D:19700101000000+00'00')" in out
+    assert b'0123456789abcdef' not in out
+    assert out == pi.normalize_pdf(pdf, 0, 'salt')
+    (tmp_path / 'a.pdf').write_bytes(out)
+    assert pi.image_size(str(tmp_path / 'a.pdf')) == (96, 48)
+
+
+def test_export_import_round_trip(im_dir, tmp_path):
+    code = '#!/bin/sh\necho hi > "$1"\n'
+    rv = pi.render('shebang', code, im_dir=im_dir)
+    bundle = str(tmp_path / 'bundle.zip')
+    assert pi.export(im_dir, bundle) == 0
+    other = str(tmp_path / 'other')
+    assert pi.import_(other, bundle) == 0
+    copy = os.path.join(other + '-images', os.path.basename(rv.path))
+    with open(copy, 'rb') as f:
+        assert f.read() == rv.data
+    assert pi.import_(other, bundle) == 0  # all present, nothing added
+
+
+def test_agent_runs_only_known_programs():
+    script = pi.to_str(pi.base64.b64encode(b'#!/bin/sh\necho hi\n'))
+    job = {'argv': ['x.shebang'], 'stdin': None,
+           'files': {'x.shebang': script}, 'outputs': []}
+    assert 'error' in pi.run_job(dict(job, argv=['sh', '-c', 'echo hi']))
+    assert 'error' in pi.run_job(job)
+    reply = pi.run_job(job, shebang=True)
+    assert reply['returncode'] == 0
+    assert pi.base64.b64decode(reply['stdout']) == b'hi\n'
+
+
+def test_agent_needs_a_token_off_loopback(monkeypatch):
+    monkeypatch.delenv('IMAGINE_AGENT_TOKEN', raising=False)
+    assert pi.cmd_agent(['-b', '0.0.0.0', '-p', '0']) == 1
+
+
+def test_budget_runs_first_block_and_releases_deferred(im_dir, tmp_path):
+    def block(word):
+        code = '#!/bin/sh\nsleep 0.6\necho %s\n' % word
+        return {'t': 'CodeBlock',
+                'c': [['', ['shebang'], [['im_out', 'stdout']]], code]}
+
+    def meta(val):
+        return {'t': 'MetaInlines', 'c': [{'t': 'Str', 'c': val}]}
+    doc = {'pandoc-api-version': [1, 23],
+           'meta': {'imagine.im_budget': meta('1'),
+                    'imagine.im_dir': meta(im_dir)},
+           'blocks': [block('one'), block('two')]}
+    p = subprocess.run([sys.executable, pi.__file__, 'html'],
+                       input=json.dumps(doc).encode(), stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+    out = p.stdout.decode()
+    # a cold cache, yet the first block renders
+    assert '"one\\n"' in out and '"two\\n"' not in out
+    root = im_dir + '-images'
+    for _ in range(100):
+        if not glob.glob(os.path.join(root, '*.deferred')):
+            break
+        time.sleep(0.1)
+    assert not glob.glob(os.path.join(root, '*.deferred'))
+    with open(os.path.join(root, 'deferred.log')) as f:
+        assert '1 rendered, 0 failed' in f.read()
+
+
+def test_import_counts_unsafe_names_as_bad(im_dir, tmp_path):
+    key = 'e' * 40
+    bundle = str(tmp_path / 'bundle.zip')
+    good, evil = key + '.png', key + '.png/../../x'
+    with zipfile.ZipFile(bundle, 'w') as z:
+        for name in (good, evil):
+            z.writestr(name, b'data')
+        digest = hashlib.sha256(b'data').hexdigest()
+        z.writestr('index.json', json.dumps({'version': 1, 'entries': {
+            key: {good: digest, evil: digest}}}))
+    assert pi.import_(im_dir, bundle) == 1
+    assert not os.path.exists(str(tmp_path / 'x'))
+    assert not os.path.exists(os.path.join(im_dir + '-images', good))
+
+
+def test_render_with_remote_is_ok_and_uploads(im_dir, tmp_path):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    code = '#!/bin/sh\necho hi > "$1"\n'
+    url = 'file://%s' % remote
+
+    def meta(im_dir):
+        'return meta for a run in im_dir, which keeps it out of the key'
+        return {'imagine.im_dir': {'t': 'MetaInlines',
+                                   'c': [{'t': 'Str', 'c': im_dir}]}}
+    rv = pi.render('shebang', code, meta=meta(im_dir), im_cache=url)
+    assert rv.ok and not rv.cached
+    assert (remote / os.path.basename(rv.path)).read_bytes() == rv.data
+    other = str(tmp_path / 'other')
+    again = pi.render('shebang', code, meta=meta(other), im_cache=url)
+    assert again.ok and again.cached and again.data == rv.data
+    assert again.path.startswith(other)
+
+
+def test_concurrent_renders_of_a_codeblock_run_once(im_dir, tmp_path):
+    code = '#!/bin/sh\necho run >> runs.txt\nsleep 0.5\necho hi > "$1"\n'
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(
+            lambda _: pi.render_shared('shebang', code, im_dir=im_dir),
+            range(4)))
+    assert all(rv.ok for rv, shared in results)
+    assert sum(1 for rv, shared in results if not shared) == 1
+    assert (tmp_path / 'runs.txt').read_text() == 'run\n'
+
+
+def test_serve_needs_token_and_refuses_shebang(im_dir, tmp_path):
+    port = free_port()
+    p = start(port, 'serve', '--http', '127.0.0.1:%d' % port, '-d', im_dir,
+              '--token', 's3cret')
+    try:
+        def post(klass, body, token=None):
+            'return status of posting body to /render/klass'
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            headers = {'Authorization': 'Bearer %s' % token} if token else {}
+            conn.request('POST', '/render/%s' % klass, body, headers)
+            status = conn.getresponse().status
+            conn.close()
+            return status
+        assert post('shebang', '#!/bin/sh\necho hi\n') == 401
+        assert post('shebang', '#!/bin/sh\necho hi\n', 's3cret') == 404
+        assert post('blockdiag', 'blockdiag { a -> b; }', 'wrong') == 401
+        assert post('blockdiag', 'blockdiag { a -> b; }', 's3cret') == 200
+    finally:
+        p.kill()
+        p.wait()
+
+
+def test_serve_needs_a_token_off_loopback(monkeypatch):
+    monkeypatch.delenv('IMAGINE_SERVE_TOKEN', raising=False)
+    assert pi.cmd_serve(['--http', '0.0.0.0:0']) == 1
+
+
+def test_warm_run_truncates_its_spill_file(tmp_path):
+    (tmp_path / 'hi.py').write_text('print("hi")\n')
+    spill = tmp_path / 'out.txt'
+    spill.write_text('output of some earlier, longer run\n')
+    servers = pi.ForkServers()
+    try:
+        rv = servers.run(sys.executable, [], [str(tmp_path / 'hi.py')],
+                         spill=str(spill))
+    finally:
+        servers.close()
+    assert rv[0] == 0
+    assert spill.read_text() == 'hi\n'